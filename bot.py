@@ -3,8 +3,15 @@ from enum import Enum
 import re
 import concurrent.futures
 import asyncio
-
-from generator.gpt2.gpt2_generator import *
+import threading
+import time
+import traceback
+from collections import deque
+
+from generator.batching import BatchScheduler
+from generator.fair_scheduler import FairScheduler
+from generator.router import GenerationRouter
+from generator.worker_pool import WorkerCrashed, WorkerPool
 from story import grammars
 from story.story_manager import *
 from story.utils import *
@@ -14,7 +21,94 @@ from discord.ext import commands
 from discord.ext.commands import CommandNotFound, guild_only
 import psutil
 
-pool = concurrent.futures.ThreadPoolExecutor()
+# Actions wait for their share of generation while holding one of these
+# threads, so there should be one for every game that could be playing
+pool = concurrent.futures.ThreadPoolExecutor(max_workers=64)
+
+# How long to wait for other games' actions before generating, and how many
+# actions can share one run of the model
+BATCH_WINDOW = 0.05
+MAX_BATCH_SIZE = 8
+
+# Model to load from generator/gpt2/models, e.g. one converted with
+# generator/gpt2/quantize_model.py to take less memory
+MODEL_NAME = 'model_v5'
+
+# Feed the model's weights from the memory-mapped store written by
+# `python -m generator.gpt2.export_sampler --share-weights` instead of loading
+# them, so bot processes on the same (CPU only) machine share one copy
+SHARE_WEIGHTS = False
+
+# A smaller model with the same vocabulary, e.g. '124M', to generate in NumPy
+# with speculative decoding: it proposes tokens and MODEL_NAME checks several
+# at once. Both need `python -m generator.gpt2.export_numpy`. Leave it None to
+# generate with TensorFlow.
+DRAFT_MODEL_NAME = None
+
+# Cores for each generation worker process, e.g. [[0, 1, 2, 3], [4, 5, 6, 7]]
+# for two workers with four cores each. Each worker loads the model and is
+# pinned to its cores. Leave it empty to run the model in the bot's process.
+WORKER_CORES = []
+
+# URLs of generation servers started with `python -m generator.server`, e.g.
+# ['http://127.0.0.1:8787'], to leave the model loaded there when the bot
+# restarts. Each game's turns go to the same server, picked by hashing its
+# channel. Leave it empty to load the model in this process or its workers.
+GENERATION_SERVERS = []
+
+# Seconds a game waits for an action's result by default, and a generation
+# server can go without answering before its request is given up on, so a
+# server that hangs doesn't keep the game's share of generation forever
+ACTION_TIMEOUT = 90
+SERVER_TIMEOUT = 2 * ACTION_TIMEOUT
+
+# Most actions that can wait in one game's queue. Past that, players are told
+# to slow down and their actions are dropped.
+QUEUE_SIZE = 8
+
+# Guild id -> how many times the usual share of generation its games get
+# when games from several guilds are waiting, e.g. {123456789: 2}
+GUILD_WEIGHTS = {}
+
+# Most requests one game can have generating at once
+GAME_IN_FLIGHT = 1
+
+# Seconds between edits of a message that's still being written, to stay
+# inside discord's rate limit
+EDIT_INTERVAL = 1.5
+
+scheduler = None
+fair_scheduler = None
+scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    # blocking
+    global scheduler, fair_scheduler
+    with scheduler_lock:
+        if scheduler is None and GENERATION_SERVERS:
+            scheduler = GenerationRouter(GENERATION_SERVERS, timeout=SERVER_TIMEOUT)
+        elif scheduler is None and WORKER_CORES:
+            scheduler = WorkerPool(
+                WORKER_CORES, window=BATCH_WINDOW, max_batch_size=MAX_BATCH_SIZE,
+                model_name=MODEL_NAME, share_weights=SHARE_WEIGHTS, draft_model_name=DRAFT_MODEL_NAME)
+        elif scheduler is None and DRAFT_MODEL_NAME:
+            from generator.gpt2.numpy_generator import NumpyGPT2Generator
+            scheduler = BatchScheduler(
+                NumpyGPT2Generator(model_name=MODEL_NAME, draft_model_name=DRAFT_MODEL_NAME),
+                window=BATCH_WINDOW, max_batch_size=MAX_BATCH_SIZE)
+        elif scheduler is None:
+            # Only imported here, so the bot doesn't load TensorFlow when the
+            # model runs in servers or workers
+            from generator.gpt2.gpt2_generator import get_shared_generator
+            scheduler = BatchScheduler(
+                get_shared_generator(model_name=MODEL_NAME, share_weights=SHARE_WEIGHTS), window=BATCH_WINDOW, max_batch_size=MAX_BATCH_SIZE)
+        if fair_scheduler is None:
+            # Enough slots to fill a batch in every worker or server
+            slots = MAX_BATCH_SIZE * max(len(GENERATION_SERVERS), len(WORKER_CORES), 1)
+            fair_scheduler = FairScheduler(
+                scheduler, slots=slots, game_limit=GAME_IN_FLIGHT, guild_weights=GUILD_WEIGHTS)
+        return scheduler
 
 
 class GameMode(Enum):
@@ -68,17 +162,24 @@ class Visibility(Enum):
 
 def create_story_manager(game):
     # blocking
-    generator = GPT2Generator()
+    generator = get_scheduler()
+    if isinstance(generator, GenerationRouter):
+        # So the story's first turn already goes where the rest will
+        generator = generator.route(game.channel.id)
+    generator = fair_scheduler.game(game.channel.guild.id, game.channel.id, generator)
     story_manager = UnconstrainedStoryManager(generator)
+    story_manager.options = game.options
     res = story_manager.start_new_story(
         game.prompt, context="", upload_story=False
     )
+    story_manager.story.token_budget = game.token_budget
     return (story_manager, res)
 
 
 class Game:
     def __init__(self, owner, channel):
-        self._queue = []
+        self._queue = asyncio.Queue(QUEUE_SIZE)
+        self._consumer = None
         self.owner = owner
         self.nsfw = False
         self.channel = channel
@@ -92,8 +193,15 @@ class Game:
         self.vote_retry = False
         self.story_manager = None
         self.prompt = None
-        self.timeout = 90
+        self.timeout = ACTION_TIMEOUT
+        self.token_budget = None
+        # Sampling settings for this game alone, shared with its story manager
+        self.options = {}
         self.calculating = False
+        # Seconds the latest actions waited in the queue, and how many
+        # actions were dropped because it was full
+        self.waits = deque(maxlen=100)
+        self.dropped = 0
 
     async def initialize_story_manager(self):
         loop = asyncio.get_event_loop()
@@ -103,46 +211,136 @@ class Game:
         return res
 
     async def consume_queue(self):
-        self.calculating = True
-        to_calc = self._queue.pop(0)
-        if to_calc:
-            loop = asyncio.get_event_loop()
+        """Run the queued actions one at a time, for as long as the game exists"""
+        while True:
+            action = await self._queue.get()
             try:
-                res = await asyncio.wait_for(loop.run_in_executor(
-                    pool, self.story_manager.act, f'\n{to_calc[0]} {to_calc[1]}.\n'), self.timeout, loop=loop)
-                await self.channel.send(
-                    discord.utils.escape_mentions(
-                        discord.utils.escape_markdown(
-                            f'> {to_calc[0]} {to_calc[1]}.\n{res}')))
-            except asyncio.TimeoutError:
-                await self.channel.send('That took too long :v ... Try another action :3')
-            self.player_idx += 1
-            self.player_idx %= len(self.players)
-            if len(self._queue) > 0:
-                await self.consume_queue()
+                await self.run_action(*action)
+            except asyncio.CancelledError:
+                # The game was deleted (before Python 3.8 this is an Exception)
+                raise
+            except Exception:
+                # Like discord failing to send a message, which is no reason
+                # to stop running the game's actions
+                traceback.print_exc()
+
+    async def run_action(self, name, msg, queued):
+        loop = asyncio.get_event_loop()
+        self.waits.append(time.monotonic() - queued)
+        if not self.started:
+            # Stopped while the action was waiting
+            return
+        self.calculating = True
+        try:
+            async with self.channel.typing():
+                await asyncio.wait_for(self.write_result(name, msg), self.timeout, loop=loop)
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            await self.channel.send('That took too long :v ... Try another action :3')
+        except WorkerCrashed:
+            await self.channel.send('The storyteller fell over :( ... Try another action')
+        except Exception as e:
+            traceback.print_exc()
+            await self.channel.send(f'ERROR EXECUTING ACTION: {e}')
+        finally:
+            self.calculating = False
+        self.player_idx += 1
+        self.player_idx %= len(self.players)
+        if self._queue.empty() and self.gamemode == GameMode.Ordered:
+            mem = self.channel.guild.get_member(
+                self.players[self.player_idx])
+            if mem:
+                await self.channel.send(f'It\'s your turn, {mem.mention}!')
             else:
-                if self.gamemode == GameMode.Ordered:
-                    mem = self.channel.guild.get_member(
-                        self.players[self.player_idx])
-                    if mem:
-                        await self.channel.send(f'It\'s your turn, {mem.mention}!')
+                print('WARNING: MEMBER IS None')
+                print('playerid:', self.players[self.player_idx])
+
+    async def write_result(self, name, msg):
+        """Run an action and post the result, editing it in as it's written"""
+        loop = asyncio.get_event_loop()
+        # The game can be stopped while this runs
+        story_manager = self.story_manager
+        cancelled = threading.Event()
+        sampled = ['']
+
+        def stream(text):
+            # called from the generating thread
+            sampled[0] = text
+
+        def show(res):
+            return discord.utils.escape_mentions(
+                discord.utils.escape_markdown(f'> {name} {msg}.\n{res}'))
+
+        future = loop.run_in_executor(
+            pool, story_manager.act, f'\n{name} {msg}.\n', stream, cancelled)
+        message = None
+        shown = ''
+        try:
+            while True:
+                done, _ = await asyncio.wait([future], timeout=EDIT_INTERVAL)
+                if done:
+                    break
+                # Only whole sentences, cleaned up like the final result will
+                # be, so nothing is shown until the first one is finished
+                text = re.split('[<>]', sampled[0])[0]
+                if not re.search('[.!?]', text):
+                    continue
+                preview = story_manager.generator.result_replace(text)
+                if preview and preview != shown:
+                    if message is None:
+                        message = await self.channel.send(show(preview))
                     else:
-                        print('WARNING: MEMBER IS None')
-                        print('playerid:', self.players[self.player_idx])
-        self.calculating = False
+                        await message.edit(content=show(preview))
+                    shown = preview
+        except asyncio.CancelledError:
+            # Timed out, or the game was deleted. The action is dropped if it
+            # hasn't got its turn to generate yet, and its result if it has.
+            cancelled.set()
+            future.cancel()
+            story_manager.generator.withdraw()
+            raise
+
+        res = future.result()
+        if message is None:
+            await self.channel.send(show(res))
+        elif res != shown:
+            await message.edit(content=show(res))
 
     async def add_to_queue(self, player, msg):
+        """Queue an action, returning False if the queue is full"""
         if self.gamemode == GameMode.Ordered:
-            if self.players[self.player_idx] == player.id:
-                self._queue.append((player.display_name, msg))
-                if not self.calculating:
-                    await self.consume_queue()
-        elif self.gamemode == GameMode.Anarchy:
-            self._queue.append((player.display_name, msg))
-            if not self.calculating:
-                await self.consume_queue()
-        else:
+            if self.players[self.player_idx] != player.id:
+                return True
+        elif self.gamemode != GameMode.Anarchy:
             raise Exception('Gamemode is out of bounds')
+        try:
+            self._queue.put_nowait((player.display_name, msg, time.monotonic()))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+        if self._consumer is None or self._consumer.done():
+            # Not started yet, or ended by something consume_queue didn't
+            # expect
+            self._consumer = asyncio.ensure_future(self.consume_queue())
+        return True
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    async def stop(self):
+        """Stop the game, freeing its story's cache"""
+        self.started = False
+        story_manager, self.story_manager = self.story_manager, None
+        if story_manager is not None:
+            # blocking when the cache is in a worker or server
+            await asyncio.get_event_loop().run_in_executor(pool, story_manager.close)
+
+    async def close(self):
+        """Stop running actions, when the game is deleted"""
+        if self._consumer is not None:
+            self._consumer.cancel()
+        await self.stop()
 
 
 # TODO: persist this
@@ -163,6 +361,8 @@ bot = commands.Bot(command_prefix='!')
 #    x gamemode
 #    x prompt
 #    x timeout
+#    x budget
+#    x temperature
 #    x votable
 #      x kick
 #      x revert
@@ -291,10 +491,7 @@ async def stop(ctx, chan: typing.Optional[discord.TextChannel]):
     """Stop a game"""
     chan = owned_game_channel(ctx, chan)
     game = channel_games[chan.id]
-    game.started = False
-    if game.story_manager:
-        game.story_manager.generator.sess.close()
-        game.story_manager = None
+    await game.stop()
     await ctx.send('Ok, game stopped c:')
 
 
@@ -320,10 +517,7 @@ async def delete(ctx, chan: typing.Optional[discord.TextChannel]):
     """Delete one of your games"""
     chan = owned_game_channel(ctx, chan)
     if chan.id in channel_games and channel_games[chan.id].owner == ctx.author.id:
-        game = channel_games[chan.id]
-        if game.story_manager:
-            game.story_manager.generator.sess.close()
-        channel_games.pop(chan.id)
+        await channel_games.pop(chan.id).close()
         await chan.delete()
         if not ctx.channel == chan:
             await ctx.send('Okay, game deleted!')
@@ -445,6 +639,43 @@ async def timeout(ctx, timeout: typing.Optional[float], chan: typing.Optional[di
         await ctx.send(f'Current timeout is {game.timeout} seconds')
 
 
+@guild_only()
+@config.command()
+async def budget(ctx, tokens: typing.Optional[int], chan: typing.Optional[discord.TextChannel]):
+    """Set how many tokens of story the bot reads before writing"""
+    chan = owned_game_channel(ctx, chan)
+    game = channel_games[chan.id]
+    if tokens is not None:
+        game.token_budget = tokens if tokens > 0 else None
+        if game.story_manager:
+            game.story_manager.story.token_budget = game.token_budget
+        await ctx.send('Gotcha, budget updated!')
+    elif game.story_manager:
+        await ctx.send(f'Current budget is {game.story_manager.context_budget()} tokens')
+    elif game.token_budget is not None:
+        await ctx.send(f'Current budget is {game.token_budget} tokens')
+    else:
+        await ctx.send('Current budget is as much as I can read')
+
+
+@guild_only()
+@config.command()
+async def temperature(ctx, temperature: typing.Optional[float], chan: typing.Optional[discord.TextChannel]):
+    """Set how adventurous the bot's writing is (higher is wilder)"""
+    chan = owned_game_channel(ctx, chan)
+    game = channel_games[chan.id]
+    if temperature is not None:
+        if temperature <= 0:
+            await ctx.send('Temperature has to be above 0')
+            return
+        game.options['temperature'] = temperature
+        await ctx.send('Gotcha, temperature updated!')
+    elif 'temperature' in game.options:
+        await ctx.send(f'Current temperature is {game.options["temperature"]}')
+    else:
+        await ctx.send('Current temperature is the default')
+
+
 @config.group()
 async def votable(ctx):
     """Configure what parts of the game are subject to democratic decision"""
@@ -540,6 +771,8 @@ async def clear_lobbies(ctx):
     """Delete all lobby channels"""
     if ctx.message.author.guild_permissions.administrator:
         for chan in get_game_channels(ctx.guild):
+            if chan.id in channel_games:
+                await channel_games.pop(chan.id).close()
             await chan.delete()
         await ctx.send('Goodbye, lobbies ~w~')
 
@@ -553,11 +786,46 @@ async def systeminfo(ctx):
     def to_gigs(b):
         return round(b / 1073741824, 1)
     await ctx.send(f'CPU usage: {cpu}%\n\nRAM usage: {to_gigs(mem.total - mem.available)} GiB / {to_gigs(mem.total)} GiB ({mem.percent}%)')
+    if scheduler:
+        # Generation servers are asked for theirs over HTTP
+        loop = asyncio.get_event_loop()
+        try:
+            distribution = await asyncio.wait_for(
+                loop.run_in_executor(pool, scheduler.batch_size_distribution), 10, loop=loop)
+        except Exception as e:
+            await ctx.send(f'Batch sizes unavailable: {e!r}')
+        else:
+            if distribution:
+                sizes = ', '.join(f'{size}: {round(share * 100)}%' for size, share in distribution.items())
+                await ctx.send(f'Batch sizes: {sizes}')
+    games = [game for game in channel_games.values() if game.started]
+    waits = sorted(wait for game in games for wait in game.waits)
+    if waits:
+        depths = [game.queue_depth() for game in games]
+        await ctx.send(
+            f'Queued actions: {sum(depths)} (deepest queue {max(depths)}), '
+            f'dropped: {sum(game.dropped for game in games)}\n'
+            f'Queue wait: {sum(waits) / len(waits):.1f} s average, '
+            f'{waits[int(len(waits) * 0.95)]:.1f} s 95th percentile')
+    if fair_scheduler and fair_scheduler.waits:
+        await ctx.send(
+            f'Wait for generation: {fair_scheduler.wait_percentile(99):.1f} s 99th percentile, '
+            f'{fair_scheduler.wait_percentile(99, ctx.guild.id if ctx.guild else None):.1f} s in this server')
+    if isinstance(scheduler, WorkerPool):
+        await ctx.send(f'Generation workers: {len(scheduler.workers)}, restarted {scheduler.restarts} times')
+    if isinstance(scheduler, GenerationRouter):
+        await ctx.send(
+            f'Generation servers: {len(scheduler.nodes)}, cache hits: {round(scheduler.hit_rate() * 100)}% '
+            f'({scheduler.misses} misses, {len(scheduler.down)} servers down)')
 
 
 @bot.event
 async def on_ready():
     print(f'Logged in as {bot.user}')
+    # Load the model once up front so starting a game doesn't have to
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(pool, get_scheduler)
+    print('Model loaded')
 
 
 @bot.event
@@ -568,8 +836,8 @@ async def on_message(msg):
     elif msg.content.startswith('> ') and msg.author.id != bot.user.id and ctx.guild and ctx.channel.id in channel_games:
         game = channel_games[ctx.channel.id]
         if game.started and msg.author.id in game.players:
-            async with ctx.channel.typing():
-                await game.add_to_queue(msg.author, msg.content[2:])
+            if not await game.add_to_queue(msg.author, msg.content[2:]):
+                await ctx.channel.send('Whoa, slow down! I\'m still writing the last few... Try again in a bit >.<')
 
 
 @bot.event
@@ -579,5 +847,8 @@ async def on_command_error(ctx, error):
     return await ctx.send(f'ERROR EXECUTING COMMAND: {error}')
     # raise error
 
-with open('.key', 'r', encoding='utf-8') as f:
-    bot.run(f.read())
+# Generation workers import this module again when they start, and mustn't
+# log in themselves
+if __name__ == '__main__':
+    with open('.key', 'r', encoding='utf-8') as f:
+        bot.run(f.read())
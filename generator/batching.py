@@ -0,0 +1,72 @@
+import collections
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from generator.stand_in import StandIn
+
+Request = collections.namedtuple(
+    "Request", ["context_tokens", "options", "cache", "stream", "future"]
+)
+
+
+class BatchScheduler(StandIn):
+    """Collects generate calls from many threads and runs them in batches.
+
+    It stands in for a generator, so a story manager can use it as-is: each
+    call blocks until the batch its prompt was put in has been generated.
+    Requests that arrive within `window` seconds of the first one waiting are
+    sent to the generator together, up to `max_batch_size` at a time.
+    Raw prompts aren't batched, and go straight to the generator.
+    """
+
+    forwarded = StandIn.forwarded | {"generate_raw", "sample_batch"}
+
+    def __init__(self, generator, window=0.05, max_batch_size=8):
+        self.generator = generator
+        self.window = window
+        self.max_batch_size = max_batch_size
+
+        # batch size -> number of batches run with that size
+        self.batch_sizes = collections.Counter()
+
+        self._requests = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def generate_tokens(self, context_tokens, options=None, cache=None, stream=None):
+        future = Future()
+        self._requests.put(Request(context_tokens, options, cache, stream, future))
+        return future.result()
+
+    def _collect(self):
+        batch = [self._requests.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            self.batch_sizes[len(batch)] += 1
+            try:
+                results = self.generator.generate_tokens_batch(
+                    [request.context_tokens for request in batch],
+                    options=[request.options for request in batch],
+                    caches=[request.cache for request in batch],
+                    streams=[request.stream for request in batch],
+                )
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            for request, result in zip(batch, results):
+                request.future.set_result(result)
@@ -0,0 +1,88 @@
+import collections
+import threading
+
+import numpy as np
+
+# A cache holds the keys and values of every token of its story's context:
+# n_layer * 2 * n_embd float32s a token. For model_v5 (48 layers, 1600 wide)
+# that's 0.6 MB a token, about 550 MB for a story filling its ~900 tokens of
+# context, so this keeps about seven full stories.
+DEFAULT_MAX_BYTES = 4 * 2 ** 30
+
+
+def cache_bytes(cache):
+    """Bytes of arrays in a story's cache."""
+    return sum(
+        value.nbytes for value in cache.values() if isinstance(value, np.ndarray)
+    )
+
+
+class CacheStore:
+    """Stories' caches, least recently used first, kept under max_bytes.
+
+    Stories can end without anyone saying so (StoryManager.close does, for
+    the ones that are stopped or deleted), so once the caches add up to more
+    than max_bytes the least recently used are emptied and forgotten. Their
+    stories still work, but their next turn runs the model over all of its
+    context again. The cache being used is never dropped, even if it's
+    bigger than max_bytes on its own. With max_bytes None nothing is.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.dropped = 0
+        self._caches = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._caches)
+
+    def get(self, key):
+        """The cache kept under key, a new one if there isn't one."""
+        if key is None:
+            return None
+        with self._lock:
+            cache = self._caches.pop(key, {})
+            self._caches[key] = cache
+            self._trim()
+        return cache
+
+    def track(self, cache):
+        """Keep count of a cache the caller holds on to itself, by its id."""
+        if self.max_bytes is None:
+            return
+        with self._lock:
+            self._caches.pop(id(cache), None)
+            # Held here too, so its id isn't reused while it's kept
+            self._caches[id(cache)] = cache
+            self._trim()
+
+    def forget(self, key):
+        """Empty the cache kept under key and stop keeping it, once its story
+        is over."""
+        with self._lock:
+            cache = self._caches.pop(key, None)
+        if cache is not None:
+            cache.clear()
+
+    def trim(self):
+        """Drop caches until the rest fit, after they've grown."""
+        with self._lock:
+            self._trim()
+
+    def nbytes(self):
+        with self._lock:
+            return sum(cache_bytes(cache) for cache in self._caches.values())
+
+    def _trim(self):
+        # Called with self._lock held. Caches grow while they're used, so
+        # they're measured again every time.
+        if self.max_bytes is None:
+            return
+        total = sum(cache_bytes(cache) for cache in self._caches.values())
+        while total > self.max_bytes and len(self._caches) > 1:
+            _, cache = self._caches.popitem(last=False)
+            total -= cache_bytes(cache)
+            # The story may still have it, so it's emptied, not just dropped
+            cache.clear()
+            self.dropped += 1
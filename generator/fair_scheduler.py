@@ -0,0 +1,186 @@
+import collections
+import contextlib
+import threading
+import time
+
+from generator.stand_in import StandIn
+
+
+class Withdrawn(Exception):
+    """The request was withdrawn while it waited for a slot."""
+
+
+class Waiting:
+    def __init__(self, game, cost):
+        self.game = game
+        self.cost = cost
+        self.granted = False
+        self.withdrawn = False
+
+
+class Guild:
+    def __init__(self):
+        # Tokens this guild can still start before its turn is over
+        self.deficit = 0
+        # game -> its waiting requests, in the order the games get turns
+        self.games = collections.OrderedDict()
+
+
+class FairScheduler:
+    """Shares generation between games by deficit round-robin.
+
+    At most `slots` requests run at once, and at most `game_limit` from any
+    one game. When a slot is free it goes to the guild whose turn it is:
+    each turn adds quantum (by default the generator's generate_num) times
+    the guild's weight in guild_weights (1 if it has none, and it has to be
+    positive) to its deficit, and the guild starts requests while the
+    deficit covers the tokens they sample. Within a guild, games take turns.
+    So a guild flooding with actions only gets its share of the slots, and a
+    quiet game's action waits for at most a turn of every other guild, not
+    for all their work.
+
+    Requests are only put in order here; they run on whatever generator the
+    game's stand-in from game() was given.
+    """
+
+    def __init__(
+        self, generator, slots=8, game_limit=1, guild_weights=None, quantum=None
+    ):
+        self.generator = generator
+        self.slots = slots
+        self.game_limit = game_limit
+        self.guild_weights = dict(guild_weights or {})
+        self.quantum = quantum or generator.generate_num
+        # A guild whose turns add nothing would never get to start anything,
+        # and the search for the next request would never end
+        if self.quantum <= 0:
+            raise ValueError("quantum must be positive, not %r" % self.quantum)
+        for guild, weight in self.guild_weights.items():
+            if weight <= 0:
+                raise ValueError(
+                    "Guild %r's weight must be positive, not %r" % (guild, weight)
+                )
+
+        self._condition = threading.Condition()
+        # guild -> Guild with waiting requests, in the order of their turns
+        self._guilds = collections.OrderedDict()
+        self._running = 0
+        self._in_flight = collections.Counter()
+
+        # Seconds the latest requests waited for a slot, by guild
+        self.waits = collections.defaultdict(lambda: collections.deque(maxlen=1000))
+
+    def game(self, guild, game, generator=None):
+        """A generator for one game's stories that waits for its share.
+
+        generator is what its requests run on, self.generator by default.
+        """
+        return FairShare(self, guild, game, generator or self.generator)
+
+    def _next(self):
+        """The next request to start, or None if none can yet."""
+        guilds = self._guilds.values()
+        if all(self._startable(guild) is None for guild in guilds):
+            return None
+        while True:
+            key, guild = next(iter(self._guilds.items()))
+            game = self._startable(guild)
+            if game is not None:
+                waiting = guild.games[game][0]
+                if guild.deficit >= waiting.cost:
+                    guild.deficit -= waiting.cost
+                    guild.games[game].popleft()
+                    if guild.games[game]:
+                        guild.games.move_to_end(game)
+                    else:
+                        del guild.games[game]
+                    if not guild.games:
+                        # Deficit isn't saved up while a guild has nothing
+                        del self._guilds[key]
+                    return waiting
+                guild.deficit += self.quantum * self.guild_weights.get(key, 1)
+            self._guilds.move_to_end(key)
+
+    def _startable(self, guild):
+        # The first game in turn that's under its limit
+        for game in guild.games:
+            if self._in_flight[game] < self.game_limit:
+                return game
+        return None
+
+    def _start_next(self):
+        # Called with self._condition held
+        while self._running < self.slots:
+            waiting = self._next()
+            if waiting is None:
+                break
+            waiting.granted = True
+            self._running += 1
+            self._in_flight[waiting.game] += 1
+        self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, guild, game, cost):
+        """Wait for game's turn to run a request sampling cost tokens."""
+        waiting = Waiting(game, cost)
+        start = time.monotonic()
+        with self._condition:
+            self._guilds.setdefault(guild, Guild())
+            self._guilds[guild].games.setdefault(game, collections.deque())
+            self._guilds[guild].games[game].append(waiting)
+            self._start_next()
+            self._condition.wait_for(lambda: waiting.granted or waiting.withdrawn)
+            if waiting.withdrawn:
+                raise Withdrawn()
+        self.waits[guild].append(time.monotonic() - start)
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._running -= 1
+                self._in_flight[game] -= 1
+                if not self._in_flight[game]:
+                    del self._in_flight[game]
+                self._start_next()
+
+    def withdraw(self, guild, game):
+        """Drop game's requests that are still waiting for a slot, so they
+        raise Withdrawn instead of running."""
+        with self._condition:
+            if guild in self._guilds:
+                for waiting in self._guilds[guild].games.pop(game, ()):
+                    waiting.withdrawn = True
+                if not self._guilds[guild].games:
+                    del self._guilds[guild]
+            self._condition.notify_all()
+
+    def wait_percentile(self, percentile, guild=None):
+        """Seconds the given percentile of recent requests waited for a slot."""
+        if guild is None:
+            waits = sorted(w for recent in self.waits.values() for w in recent)
+        else:
+            waits = sorted(self.waits[guild])
+        if not waits:
+            return 0.0
+        return waits[min(int(len(waits) * percentile / 100), len(waits) - 1)]
+
+
+class FairShare(StandIn):
+    """A FairScheduler's generator for the stories of one game."""
+
+    def __init__(self, scheduler, guild, game, generator):
+        self.scheduler = scheduler
+        self.guild = guild
+        self.game = game
+        self.generator = generator
+
+    def generate_tokens(self, context_tokens, options=None, cache=None, stream=None):
+        cost = (options or {}).get("generate_num", self.generator.generate_num)
+        with self.scheduler.slot(self.guild, self.game, cost):
+            return self.generator.generate_tokens(
+                context_tokens, options, cache, stream
+            )
+
+    def withdraw(self):
+        """Drop this game's requests that haven't started yet."""
+        self.scheduler.withdraw(self.guild, self.game)
@@ -0,0 +1,168 @@
+"""Time the model's prefill and decoding paths on their own.
+
+Prefill runs a whole prompt through the model, and decoding runs one token
+against the prompt's keys and values, the way every sampling step after the
+first does. "sampling step" is the time each step of sample_sequence's loop
+takes, with the keys and values in its preallocated buffer; it should hardly
+change with --prompt-length. Run from the top of the repository:
+
+    python -m generator.gpt2.benchmark --prompt-length 900 --batch-size 4
+
+With --backend numpy the same is timed for NumpyGPT2Generator's model, which
+doesn't need TensorFlow installed.
+"""
+import argparse
+import json
+import os
+import time
+import types
+
+import numpy as np
+
+
+def time_run(run, runs):
+    # The first run sets things up, so it isn't counted
+    run()
+    start = time.perf_counter()
+    for _ in range(runs):
+        run()
+    return (time.perf_counter() - start) / runs
+
+
+def tensorflow_results(args, tokens):
+    # Imported here so the numpy backend can be timed without TensorFlow
+    import tensorflow as tf
+    from generator.gpt2.src import model, sample
+
+    hparams = model.default_hparams()
+    with open(os.path.join(args.models_dir, args.model_name, "hparams.json")) as f:
+        hparams.override_from_dict(json.load(f))
+
+    prompt = tf.placeholder(tf.int32, [None, None])
+    past = tf.placeholder(tf.float32, model.past_shape(hparams=hparams))
+    # A token of static length 1 takes the decoding path. Leaving the length
+    # open makes the same step go through the general masked attention.
+    token = tf.placeholder(tf.int32, [None, 1])
+    any_length = tf.placeholder(tf.int32, [None, None])
+    prefill = model.model(hparams=hparams, X=prompt, reuse=tf.AUTO_REUSE)
+    decode = model.model(hparams=hparams, X=token, past=past, reuse=tf.AUTO_REUSE)
+    masked = model.model(hparams=hparams, X=any_length, past=past, reuse=tf.AUTO_REUSE)
+    # The prompt's last token and then steps samples, after the rest of it
+    history = tf.placeholder(tf.int32, [None, None])
+    last = tf.placeholder(tf.int32, [None, 1])
+    sampled = {
+        length: sample.sample_sequence(
+            hparams=hparams,
+            length=length,
+            context=last,
+            history=history,
+            past=past,
+            top_k=40,
+            preallocate=True,
+        )[0]
+        for length in [1, args.steps + 1]
+    }
+
+    config = tf.compat.v1.ConfigProto()
+    config.gpu_options.allow_growth = True
+    with tf.compat.v1.Session(config=config) as sess:
+        saver = tf.train.Saver()
+        saver.restore(
+            sess,
+            tf.train.latest_checkpoint(os.path.join(args.models_dir, args.model_name)),
+        )
+        presents = sess.run(prefill["present"], feed_dict={prompt: tokens})
+        step = tokens[:, -1:]
+        sampling = {
+            history: tokens[:, :-1],
+            last: step,
+            past: presents[:, :, :, :, :-1],
+        }
+        # Sampling once only runs the prompt's last token, so the difference
+        # is the loop's steps
+        loop = time_run(
+            lambda: sess.run(sampled[args.steps + 1], feed_dict=sampling), args.runs
+        ) - time_run(lambda: sess.run(sampled[1], feed_dict=sampling), args.runs)
+
+        runs = [
+            ("prefill", args.prompt_length, prefill, {prompt: tokens}),
+            ("decode", 1, decode, {token: step, past: presents}),
+            ("decode (masked)", 1, masked, {any_length: step, past: presents}),
+        ]
+        return [
+            (
+                name,
+                length,
+                time_run(
+                    lambda: sess.run(outputs["logits"], feed_dict=feed_dict), args.runs
+                ),
+            )
+            for name, length, outputs, feed_dict in runs
+        ] + [("sampling step", 1, loop / args.steps)]
+
+
+def numpy_results(args, tokens):
+    from generator.gpt2.src import numpy_model
+
+    model_dir = os.path.join(args.models_dir, args.model_name)
+    with open(os.path.join(model_dir, "hparams.json")) as f:
+        hparams = types.SimpleNamespace(**json.load(f))
+    weights = numpy_model.load_weights(os.path.join(model_dir, "weights.npz"))
+    model = numpy_model.Model(hparams, weights)
+
+    pads = np.zeros([args.batch_size], dtype=np.int64)
+    buffer = model.past_buffer(args.batch_size, args.prompt_length + 1)
+    step = tokens[:, -1:]
+    return [
+        (
+            "prefill",
+            args.prompt_length,
+            time_run(lambda: model.forward(tokens, buffer, 0, pads), args.runs),
+        ),
+        (
+            "decode",
+            1,
+            time_run(
+                lambda: model.forward(step, buffer, args.prompt_length, pads),
+                args.runs,
+            ),
+        ),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model-name", default="model_v5")
+    parser.add_argument("--models-dir", default="generator/gpt2/models")
+    parser.add_argument(
+        "--backend", choices=["tensorflow", "numpy"], default="tensorflow"
+    )
+    parser.add_argument("--prompt-length", type=int, default=900)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument(
+        "--steps", type=int, default=50, help="sampling steps timed at a time"
+    )
+    args = parser.parse_args()
+
+    with open(os.path.join(args.models_dir, args.model_name, "hparams.json")) as f:
+        n_vocab = json.load(f)["n_vocab"]
+    tokens = np.random.randint(0, n_vocab, [args.batch_size, args.prompt_length])
+    if args.backend == "numpy":
+        results = numpy_results(args, tokens)
+    else:
+        results = tensorflow_results(args, tokens)
+
+    print(
+        "%s, batch size %d, prompt of %d tokens, %d runs each"
+        % (args.backend, args.batch_size, args.prompt_length, args.runs)
+    )
+    for name, length, seconds in results:
+        print(
+            "%-16s %8.2f ms  %8.0f tokens/s"
+            % (name, seconds * 1000, args.batch_size * length / seconds)
+        )
+
+
+if __name__ == "__main__":
+    main()
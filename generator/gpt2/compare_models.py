@@ -0,0 +1,102 @@
+"""Compare a converted model with the one it was converted from.
+
+Both models read the same text, and for each this reports the perplexity,
+how often its most likely next token is the same as the original's, the
+largest difference from the original's logits, and the size of its weights.
+Run from the top of the repository:
+
+    python -m generator.gpt2.compare_models model_v5 model_v5_int8
+
+Use generator.gpt2.benchmark with --model-name to compare their speed.
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+import tensorflow as tf
+from generator.gpt2.src import encoder, model
+
+
+class Evaluator:
+    """One model in a graph and session of its own."""
+
+    def __init__(self, model_name, models_dir):
+        self.hparams = model.default_hparams()
+        with open(os.path.join(models_dir, model_name, "hparams.json")) as f:
+            self.hparams.override_from_dict(json.load(f))
+        self.enc = encoder.get_encoder(model_name, models_dir)
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.tokens = tf.placeholder(tf.int32, [1, None])
+            self.logits = model.model(hparams=self.hparams, X=self.tokens)["logits"]
+            self.sess = tf.compat.v1.Session()
+            tf.train.Saver().restore(
+                self.sess,
+                tf.train.latest_checkpoint(os.path.join(models_dir, model_name)),
+            )
+            self.weight_bytes = sum(
+                variable.shape.num_elements() * variable.dtype.size
+                for variable in tf.global_variables()
+            )
+
+    def run(self, tokens):
+        return self.sess.run(self.logits, {self.tokens: [tokens]})[0]
+
+
+def log_softmax(logits):
+    logits = logits - logits.max(axis=-1, keepdims=True)
+    return logits - np.log(np.exp(logits).sum(axis=-1, keepdims=True))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("original", help="e.g. model_v5")
+    parser.add_argument("converted", help="e.g. model_v5_int8")
+    parser.add_argument("--text", default="story/story_data.yaml")
+    parser.add_argument("--max-tokens", type=int, default=4096)
+    parser.add_argument("--models-dir", default="generator/gpt2/models")
+    args = parser.parse_args()
+
+    models = [
+        Evaluator(args.original, args.models_dir),
+        Evaluator(args.converted, args.models_dir),
+    ]
+    with open(args.text) as f:
+        tokens = models[0].enc.encode(f.read())[: args.max_tokens]
+    window = models[0].hparams.n_ctx
+
+    losses = [[] for _ in models]
+    agree = [0 for _ in models]
+    difference = [0.0 for _ in models]
+    for start in range(0, len(tokens) - 1, window):
+        chunk = tokens[start : start + window + 1]
+        targets = np.array(chunk[1:])
+        logits = [m.run(chunk[:-1]) for m in models]
+        for i, values in enumerate(logits):
+            log_probs = log_softmax(values)
+            losses[i].extend(-log_probs[np.arange(len(targets)), targets])
+            agree[i] += np.sum(values.argmax(-1) == logits[0].argmax(-1))
+            difference[i] = max(difference[i], np.abs(values - logits[0]).max())
+
+    print("%d tokens of %s" % (len(tokens) - 1, args.text))
+    print(
+        "%-24s %10s %10s %14s %10s"
+        % ("model", "perplexity", "top-1 same", "max logit diff", "weights MB")
+    )
+    for i, name in enumerate([args.original, args.converted]):
+        print(
+            "%-24s %10.3f %9.2f%% %14.4f %10.1f"
+            % (
+                name,
+                np.exp(np.mean(losses[i])),
+                100 * agree[i] / len(losses[i]),
+                difference[i],
+                models[i].weight_bytes / 1e6,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
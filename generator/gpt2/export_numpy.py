@@ -0,0 +1,32 @@
+"""Export a model's checkpoint to weights.npz for NumpyGPT2Generator.
+
+This is the only step that needs TensorFlow. Run from the top of the
+repository:
+
+    python -m generator.gpt2.export_numpy model_v5
+"""
+import argparse
+import os
+
+import numpy as np
+
+import tensorflow as tf
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("model_name", help="e.g. model_v5")
+    parser.add_argument("--models-dir", default="generator/gpt2/models")
+    args = parser.parse_args()
+
+    model_dir = os.path.join(args.models_dir, args.model_name)
+    reader = tf.train.load_checkpoint(tf.train.latest_checkpoint(model_dir))
+    weights = {
+        name: reader.get_tensor(name) for name in reader.get_variable_to_shape_map()
+    }
+    np.savez(os.path.join(model_dir, "weights.npz"), **weights)
+    print("Exported %d arrays to %s" % (len(weights), model_dir))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Export a model's sampling graph and weights so generators start quickly.
+
+Building the sampling graph and restoring the checkpoint is what makes a new
+GPT2Generator slow. This builds it once and saves the graph, along with the
+weights in a flat file that later generators memory-map. Run from the top of
+the repository:
+
+    python -m generator.gpt2.export_sampler model_v5
+
+GPT2Generator uses the export whenever it's made with the same stop_strings,
+min_length, preallocate_past and share_weights, from the same checkpoint and
+with the same version of the graph's code (sampler.json records a
+fingerprint of each). Otherwise it builds the graph from the checkpoint as if
+there were no export, so export again after changing any of them. Export
+with --share-weights for worker processes that should share one copy of the
+weights.
+
+Before finishing, this checks that a generator loaded from the export samples
+exactly the same text as one built from the checkpoint, given the same seed.
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+
+from generator.gpt2 import gpt2_generator
+from generator.gpt2.gpt2_generator import GPT2Generator
+
+
+def timed(make):
+    start = time.perf_counter()
+    return make(), time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("model_name", nargs="?", default="model_v5")
+    parser.add_argument("--no-preallocate-past", action="store_true")
+    parser.add_argument("--share-weights", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--prompt", default="You are a knight living in the kingdom of Larion."
+    )
+    args = parser.parse_args()
+    kwargs = {
+        "model_name": args.model_name,
+        "preallocate_past": not args.no_preallocate_past,
+    }
+
+    built, built_seconds = timed(lambda: GPT2Generator(use_export=False, **kwargs))
+    built.export()
+    if args.share_weights:
+        # The weights are in the store now, and the graph that's fed them
+        # replaces the one with variables
+        GPT2Generator(use_export=False, share_weights=True, **kwargs).export()
+    loaded, loaded_seconds = timed(
+        lambda: GPT2Generator(share_weights=args.share_weights, **kwargs)
+    )
+    assert loaded.from_export
+
+    results = []
+    for generator in [built, loaded]:
+        np.random.seed(args.seed)
+        results.append(generator.generate_raw_batch([args.prompt] * 2))
+    if results[0] != results[1]:
+        for name in [gpt2_generator.EXPORT_GRAPH, gpt2_generator.EXPORT_INDEX]:
+            os.remove(os.path.join(built.checkpoint_path, name))
+        raise SystemExit(
+            "The exported graph sampled different text, so it was removed:\n"
+            "%r\n%r" % tuple(results)
+        )
+
+    print("Exported %s, and it samples the same text" % built.checkpoint_path)
+    print("Building from the checkpoint took %.1f s" % built_seconds)
+    print("Loading the export took %.1f s" % loaded_seconds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,447 @@
+import itertools
+import json
+import os
+import queue
+import threading
+import types
+
+import numpy as np
+
+from generator.caches import DEFAULT_MAX_BYTES, CacheStore
+from generator.gpt2.src import encoder
+from story.utils import *
+
+
+def call_stream(stream, text):
+    """Pass text to stream, returning False if it raised.
+
+    A stream that fails (like one whose client went away) should stop being
+    called, but the request it's for, and the rest of its batch, carry on.
+    """
+    try:
+        stream(text)
+    except Exception as e:
+        print("Stopped streaming a result: %s: %s" % (type(e).__name__, e))
+        return False
+    return True
+
+
+class GeneratorBase:
+    """Everything a GPT-2 generator does but run the model.
+
+    Cleaning up prompts and results, candidates, stories' caches, batching
+    rows together and streaming work the same whatever runs the model, so a
+    backend only has to set itself up in __init__ and implement run_batch.
+    """
+
+    def __init__(
+        self,
+        generate_num=60,
+        temperature=0.4,
+        top_k=40,
+        top_p=0.9,
+        censor=True,
+        stop_strings=("<", ">"),
+        min_length=0,
+        candidates=1,
+        max_attempts=3,
+        repetition_penalty=0.85,
+        model_name="model_v5",
+        max_cache_bytes=DEFAULT_MAX_BYTES,
+    ):
+        self.generate_num = generate_num
+        self.temp = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        # Sampling settings a request can override through its options
+        self.defaults = {
+            "generate_num": generate_num,
+            "temperature": temperature,
+            "top_k": top_k,
+            "top_p": top_p,
+            "repetition_penalty": repetition_penalty,
+        }
+        self.censor = censor
+        # result_replace throws away everything from the first < or > on, so
+        # by default sampling stops there too
+        self.stop_strings = stop_strings
+        self.min_length = min_length
+        # Each prompt is sampled this many times in the same run and the
+        # first usable result is kept. If none are, it's tried again, up to
+        # max_attempts runs. Every candidate is another row in every run, and
+        # unusable results are rare, so by default there's just the one.
+        self.candidates = candidates
+        self.max_attempts = max_attempts
+        self.repetition_penalty = repetition_penalty
+
+        # A model converted by quantize_model can be used in place of model_v5
+        self.model_name = model_name
+        self.model_dir = "generator/gpt2/models"
+        self.checkpoint_path = os.path.join(self.model_dir, self.model_name)
+
+        models_dir = os.path.expanduser(os.path.expandvars(self.model_dir))
+
+        self.enc = encoder.get_encoder(self.model_name, models_dir)
+        self.hparams = self.load_hparams(
+            os.path.join(models_dir, self.model_name, "hparams.json")
+        )
+        # Longest prompt that still leaves room in n_ctx for the sample
+        self.context_budget = self.hparams.n_ctx - self.generate_num
+        self.streams = {}
+        self.next_stream_key = itertools.count(1)
+        # Stories' caches are the caller's, but they're kept count of here.
+        # Callers that keep their own CacheStore (generator.server and
+        # WorkerPool's workers) pass None.
+        self.story_caches = CacheStore(max_cache_bytes)
+
+    def load_hparams(self, path):
+        with open(path) as f:
+            return types.SimpleNamespace(**json.load(f))
+
+    def past_shape(self, batch_size=None, sequence=None):
+        return [
+            batch_size,
+            self.hparams.n_layer,
+            2,
+            self.hparams.n_head,
+            sequence,
+            self.hparams.n_embd // self.hparams.n_head,
+        ]
+
+    def run_batch(
+        self, history, context, past, pads, stream_keys, settings, caches=None
+    ):
+        """Sample a continuation of every row of history + context.
+
+        history and context are lists of equal length token lists, with
+        pads[row] tokens of left padding at the start of each history row,
+        and past has the keys and values for history. settings maps each
+        of self.defaults to a list with a value per row. Steps are reported
+        to on_sample with stream_keys. caches has each row's story cache (or
+        None), for backends that keep more than the model's keys and values
+        between turns.
+
+        Returns the tokens, the keys and values for all but the last of them
+        and how many tokens each row sampled, like sample.sample_sequence.
+        Past a row's own length, its tokens and keys and values are unused.
+        """
+        raise NotImplementedError()
+
+    def stop_tokens(self, stop_strings):
+        """Token ids that contain a stop string, and the id sequences of stop
+        strings that don't fit in a single token."""
+        stop_tokens = []
+        for token in self.enc.decoder:
+            text = self.enc.decode([token])
+            if any(stop in text for stop in stop_strings):
+                stop_tokens.append(token)
+        stop_sequences = []
+        for stop in stop_strings:
+            sequence = self.enc.encode(stop)
+            if len(sequence) > 1:
+                stop_sequences.append(sequence)
+        return stop_tokens, stop_sequences
+
+    def on_sample(self, stream_keys, samples, done):
+        # Called by the graph after every sampling step
+        for key, token, stopped in zip(stream_keys, samples[:, 0], done):
+            if key not in self.streams or stopped:
+                continue
+            stream, tokens = self.streams[key]
+            tokens.append(token)
+            text = self.enc.decode(tokens)
+            # Wait for the rest of a character split across tokens
+            if text.endswith("\ufffd"):
+                continue
+            if not call_stream(stream, text):
+                del self.streams[key]
+        return True
+
+    def prompt_replace(self, prompt):
+        # print("\n\nBEFORE PROMPT_REPLACE:")
+        # print(repr(prompt))
+        if len(prompt) > 0 and prompt[-1] == " ":
+            prompt = prompt[:-1]
+
+        # prompt = second_to_first_person(prompt)
+
+        # print("\n\nAFTER PROMPT_REPLACE")
+        # print(repr(prompt))
+        return prompt
+
+    def result_replace(self, result, censor=None):
+        # print("\n\nBEFORE RESULT_REPLACE:")
+        # print(repr(result))
+
+        result = cut_trailing_sentence(result)
+        return self.clean_result(result, censor)
+
+    def clean_result(self, result, censor=None):
+        if len(result) == 0:
+            return ""
+        first_letter_capitalized = result[0].isupper()
+        result = result.replace('."', '".')
+        result = result.replace("#", "")
+        result = result.replace("*", "")
+        result = result.replace("\n\n", "\n")
+        # result = first_to_second_person(result)
+        # A request can say whether it wants censoring, or leave it to self
+        if self.censor if censor is None else censor:
+            result = remove_profanity(result)
+
+        # The replacements above can leave nothing behind, and one bad row
+        # shouldn't take down the rest of its batch
+        if not first_letter_capitalized and len(result) > 0:
+            result = result[0].lower() + result[1:]
+
+        #
+        # print("\n\nAFTER RESULT_REPLACE:")
+        # print(repr(result))
+
+        return result
+
+    def fallback_result(self, result, censor=None):
+        # For when no candidate survives result_replace: keep whatever came
+        # before the first < or >, even if it isn't a whole sentence
+        result = standardize_punctuation(result)
+        for stop in ["<", ">"]:
+            result = result.split(stop)[0]
+        return self.clean_result(result.strip(), censor)
+
+    def encode(self, text):
+        return self.enc.encode(text)
+
+    def prompt_tokens_replace(self, context_tokens):
+        # Same as prompt_replace for prompts that are already tokenized
+        if len(context_tokens) > 0 and self.enc.decode(context_tokens[-1:]) == " ":
+            context_tokens = context_tokens[:-1]
+        return context_tokens
+
+    def split_cached(self, context_tokens, cache):
+        """Work out how much of context_tokens a story's cache can skip.
+
+        Returns how many leading tokens are covered and their cached keys and
+        values. At least one token is always left over to run the model on.
+        """
+        cached = 0
+        # Read once, since another thread can empty a cache that's dropped
+        tokens = cache.get("tokens") if cache else None
+        presents = cache.get("presents") if cache else None
+        if tokens is not None and presents is not None:
+            limit = min(len(tokens), len(context_tokens) - 1)
+            while cached < limit and tokens[cached] == context_tokens[cached]:
+                cached += 1
+        if cached == 0:
+            past = np.zeros(self.past_shape(batch_size=1, sequence=0), np.float32)
+        else:
+            past = presents[:, :, :, :, :cached]
+        return cached, past
+
+    def pad_past(self, past, pad, length):
+        """Keys and values for the first length tokens of a row once it's been
+        left padded by pad tokens, from the ones for its unpadded tokens."""
+        kept = max(length - pad, 0)
+        past = past[:, :, :, :, :kept]
+        padding = np.zeros(
+            past.shape[:4] + (length - kept,) + past.shape[5:], dtype=past.dtype
+        )
+        return np.concatenate([padding, past], axis=4)
+
+    def row_options(self, options, rows):
+        """One options dict per row, from None, one dict for all rows or a list."""
+        if options is None:
+            return [{}] * rows
+        if isinstance(options, dict):
+            return [options] * rows
+        return [row or {} for row in options]
+
+    def sample_batch(self, contexts, caches=None, streams=None, options=None):
+        # Rows are left padded to the same length so they can share a run.
+        # They're bucketed on how many tokens still have to be run through
+        # the model, so padding never more than doubles a row's share of it.
+        if caches is None:
+            caches = [None] * len(contexts)
+        if streams is None:
+            streams = [None] * len(contexts)
+        options = self.row_options(options, len(contexts))
+        settings = [
+            {name: row.get(name, value) for name, value in self.defaults.items()}
+            for row in options
+        ]
+        # Anything past the budget would run off the end of the position table
+        contexts = [
+            tokens[-(self.hparams.n_ctx - settings[i]["generate_num"]) :]
+            for i, tokens in enumerate(contexts)
+        ]
+        cached = [0] * len(contexts)
+        pasts = [None] * len(contexts)
+        groups = {}
+        for i, context_tokens in enumerate(contexts):
+            cached[i], pasts[i] = self.split_cached(context_tokens, caches[i])
+            key = (len(context_tokens) - cached[i]).bit_length()
+            groups.setdefault(key, []).append(i)
+
+        texts = [None] * len(contexts)
+        for rows in groups.values():
+            total = max(len(contexts[i]) for i in rows)
+            pads = [total - len(contexts[i]) for i in rows]
+            padded = [[0] * pad + contexts[i] for pad, i in zip(pads, rows)]
+            # Only as much history as every row has cached can be fed as past
+            split = min(pad + cached[i] for pad, i in zip(pads, rows))
+            past = np.concatenate(
+                [self.pad_past(pasts[i], pad, split) for pad, i in zip(pads, rows)]
+            )
+            row_settings = {
+                name: [settings[i][name] for i in rows] for name in self.defaults
+            }
+            stream_keys = [self.open_stream(streams[i]) for i in rows]
+            try:
+                out, presents, lengths = self.run_batch(
+                    history=[tokens[:split] for tokens in padded],
+                    context=[tokens[split:] for tokens in padded],
+                    past=past,
+                    pads=pads,
+                    stream_keys=stream_keys,
+                    settings=row_settings,
+                    caches=[caches[i] for i in rows],
+                )
+            finally:
+                for key in stream_keys:
+                    self.streams.pop(key, None)
+            for row, i in enumerate(rows):
+                texts[i] = self.enc.decode(out[row, total : total + lengths[row]])
+                if caches[i] is not None:
+                    # The last sampled token was never run through the model.
+                    # presents is a view into the whole run's output, so
+                    # callers should copy the ones they keep.
+                    pad = pads[row]
+                    end = total + lengths[row] - 1
+                    caches[i]["tokens"] = out[row, pad:end].tolist()
+                    caches[i]["presents"] = presents[row : row + 1, :, :, :, pad:end]
+        return texts
+
+    def open_stream(self, stream):
+        if stream is None:
+            return 0
+        key = next(self.next_stream_key)
+        self.streams[key] = (stream, [])
+        return key
+
+    def generate_raw_batch(self, prompts, caches=None, options=None):
+        contexts = [self.enc.encode(prompt) for prompt in prompts]
+        return self.sample_batch(contexts, caches, options=options)
+
+    def generate_raw(self, prompt, options=None):
+        return self.generate_raw_batch([prompt], options=options)[0]
+
+    def generate_raw_stream(self, prompt):
+        """Like generate_raw, but yields the text in pieces as it's sampled."""
+        pieces = queue.Queue()
+        sampled = [""]
+
+        def stream(text):
+            pieces.put(text[len(sampled[0]) :])
+            sampled[0] = text
+
+        def sample():
+            try:
+                self.sample_batch([self.enc.encode(prompt)], streams=[stream])
+            finally:
+                pieces.put(None)
+
+        threading.Thread(target=sample, daemon=True).start()
+        while True:
+            piece = pieces.get()
+            if piece is None:
+                return
+            yield piece
+
+    def generate_tokens_batch(self, contexts, options=None, caches=None, streams=None):
+
+        debug_print = False
+        contexts = [self.prompt_tokens_replace(tokens) for tokens in contexts]
+        options = self.row_options(options, len(contexts))
+        if caches is None:
+            caches = [None] * len(contexts)
+        if streams is None:
+            streams = [None] * len(contexts)
+        results = [None] * len(contexts)
+        texts = [None] * len(contexts)
+        todo = list(range(len(contexts)))
+
+        for _ in range(self.max_attempts):
+            if debug_print:
+                print("******DEBUG******")
+                print(
+                    "Prompts are: ",
+                    [repr(self.enc.decode(contexts[i])) for i in todo],
+                )
+
+            # Every candidate starts from the story's cache but gets its own
+            # dict, and only the one that's kept is written back. Only the
+            # first candidate is streamed.
+            rows = [(i, n) for i in todo for n in range(self.candidates)]
+            candidate_caches = [
+                None if caches[i] is None else dict(caches[i]) for i, _ in rows
+            ]
+            candidate_texts = self.sample_batch(
+                [contexts[i] for i, _ in rows],
+                candidate_caches,
+                [streams[i] if n == 0 else None for i, n in rows],
+                [options[i] for i, _ in rows],
+            )
+
+            if debug_print:
+                print("Generated results are: ", [repr(t) for t in candidate_texts])
+                print("******END DEBUG******")
+
+            kept = {}
+            for row, (i, n) in enumerate(rows):
+                if i in kept:
+                    continue
+                result = self.result_replace(
+                    candidate_texts[row], options[i].get("censor")
+                )
+                if len(result) > 0 or n == self.candidates - 1:
+                    # Fall back on the first candidate's cache if none work
+                    kept[i] = row if len(result) > 0 else row - n
+                    results[i] = result
+                    texts[i] = candidate_texts[row - n]
+            for i, row in kept.items():
+                if caches[i] is not None:
+                    caches[i].update(candidate_caches[row])
+                    caches[i]["presents"] = candidate_caches[row]["presents"].copy()
+                    self.story_caches.track(caches[i])
+
+            todo = [i for i in todo if len(results[i]) == 0]
+            if len(todo) == 0:
+                break
+
+        for i in todo:
+            results[i] = self.fallback_result(texts[i], options[i].get("censor"))
+        return results
+
+    def forget_cache(self, cache):
+        """Empty a story's cache once the story is over, to free its memory."""
+        self.story_caches.forget(id(cache))
+        cache.clear()
+
+    def generate_tokens(self, context_tokens, options=None, cache=None, stream=None):
+        return self.generate_tokens_batch(
+            [context_tokens], options, [cache], [stream]
+        )[0]
+
+    def generate_batch(self, prompts, options=None, caches=None, streams=None):
+        contexts = [self.enc.encode(self.prompt_replace(prompt)) for prompt in prompts]
+        return self.generate_tokens_batch(contexts, options, caches, streams)
+
+    def generate(self, prompt, options=None, seed=1, cache=None, stream=None):
+        """Continue prompt and clean up the result.
+
+        options can override the generator's generate_num, temperature, top_k,
+        top_p, repetition_penalty and censor for this prompt alone.
+
+        If given, stream is called with the raw text sampled so far every
+        time it grows (starting over if an empty result has to be retried).
+        """
+        return self.generate_batch([prompt], options, [cache], [stream])[0]
@@ -1,131 +1,330 @@
+import hashlib
 import json
 import os
+import threading
 import warnings
 
 import numpy as np
 
 import tensorflow as tf
-from generator.gpt2.src import encoder, model, sample
-from story.utils import *
+from generator.gpt2 import weight_store
+from generator.gpt2.generator_base import GeneratorBase
+from generator.gpt2.src import model, sample
 
 warnings.filterwarnings("ignore")
 
 tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
 
+# What GPT2Generator.export writes next to the checkpoint, besides the
+# weight store
+EXPORT_GRAPH = "sampler.meta"
+EXPORT_INDEX = "sampler.json"
 
-class GPT2Generator:
-    def __init__(self, generate_num=60, temperature=0.4, top_k=40, top_p=0.9, censor=True):
-        self.generate_num = generate_num
-        self.temp = temperature
-        self.top_k = top_k
-        self.top_p = top_p
-        self.censor = censor
+# The code the sampling graph is built from. An export made with other
+# versions of these files isn't used.
+GRAPH_SOURCES = [model.__file__, sample.__file__, __file__]
 
-        self.model_name = "model_v5"
-        self.model_dir = "generator/gpt2/models"
-        self.checkpoint_path = os.path.join(self.model_dir, self.model_name)
+_shared_generator = None
+_shared_generator_lock = threading.Lock()
 
-        models_dir = os.path.expanduser(os.path.expandvars(self.model_dir))
-        self.batch_size = 1
-        self.samples = 1
 
-        self.enc = encoder.get_encoder(self.model_name, models_dir)
-        hparams = model.default_hparams()
-        with open(os.path.join(models_dir, self.model_name, "hparams.json")) as f:
-            hparams.override_from_dict(json.load(f))
-        seed = np.random.randint(0, 100000)
+def fingerprint(paths):
+    digest = hashlib.md5()
+    for path in paths:
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def get_shared_generator(**kwargs):
+    """Return the process-wide generator, loading the model on first use.
+
+    Building a GPT2Generator creates a session, the sampling graph and restores
+    the whole checkpoint, so callers that serve several stories at once (like
+    the discord bot) should borrow this one instead of making their own.
+    kwargs are passed to GPT2Generator by whichever call loads it.
+    """
+    global _shared_generator
+    with _shared_generator_lock:
+        if _shared_generator is None:
+            _shared_generator = GPT2Generator(**kwargs)
+        return _shared_generator
+
+
+class GPT2Generator(GeneratorBase):
+    """Runs the model in a TensorFlow session, sampling in the graph.
+
+    If generator/gpt2/export_sampler.py has exported this model's sampling
+    graph with the same stop_strings, min_length and preallocate_past, the
+    graph is imported and the weights mapped from the export, which is much
+    faster than building the graph and restoring the checkpoint.
+
+    With share_weights the weights aren't copied into variables at all. They
+    stay in the export's memory-mapped weight store and are fed to every run,
+    so all the processes using a model on one machine share a single copy of
+    it. That suits CPU workers; on a GPU the weights would be copied over on
+    every run.
+
+    intra_op_threads and inter_op_threads size TensorFlow's thread pools, for
+    processes that only get some of the machine's cores.
+    """
+
+    # Tensors the generator feeds and runs, found by name in an exported graph
+    tensor_names = [
+        "context",
+        "history",
+        "past",
+        "pads",
+        "stream_keys",
+        "seed",
+        "output",
+        "presents",
+        "lengths",
+    ]
+
+    def __init__(
+        self,
+        *args,
+        preallocate_past=True,
+        use_export=True,
+        share_weights=False,
+        intra_op_threads=0,
+        inter_op_threads=0,
+        **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+        self.preallocate_past = preallocate_past
+        self.share_weights = share_weights
+        # Placeholders standing in for variables with share_weights, by name
+        self.weight_inputs = {}
+        self.weight_feed = {}
 
         config = tf.compat.v1.ConfigProto()
         config.gpu_options.allow_growth = True
-        self.sess = tf.compat.v1.Session(config=config)
-
-        self.context = tf.placeholder(tf.int32, [self.batch_size, None])
-        # np.random.seed(seed)
-        # tf.set_random_seed(seed)
-        self.output = sample.sample_sequence(
-            hparams=hparams,
-            length=self.generate_num,
-            context=self.context,
-            batch_size=self.batch_size,
-            temperature=temperature,
-            top_k=top_k,
-            top_p=top_p,
-        )
+        # 0 leaves it to TensorFlow, which uses every core
+        config.intra_op_parallelism_threads = intra_op_threads
+        config.inter_op_parallelism_threads = inter_op_threads
+        # A graph of its own, so exported and built generators can coexist
+        self.graph = tf.Graph()
+        self.sess = tf.compat.v1.Session(graph=self.graph, config=config)
 
-        saver = tf.train.Saver()
-        ckpt = tf.train.latest_checkpoint(os.path.join(models_dir, self.model_name))
-        saver.restore(self.sess, ckpt)
-
-    def prompt_replace(self, prompt):
-        # print("\n\nBEFORE PROMPT_REPLACE:")
-        # print(repr(prompt))
-        if len(prompt) > 0 and prompt[-1] == " ":
-            prompt = prompt[:-1]
-
-        # prompt = second_to_first_person(prompt)
-
-        # print("\n\nAFTER PROMPT_REPLACE")
-        # print(repr(prompt))
-        return prompt
-
-    def result_replace(self, result):
-        # print("\n\nBEFORE RESULT_REPLACE:")
-        # print(repr(result))
-
-        result = cut_trailing_sentence(result)
-        if len(result) == 0:
-            return ""
-        first_letter_capitalized = result[0].isupper()
-        result = result.replace('."', '".')
-        result = result.replace("#", "")
-        result = result.replace("*", "")
-        result = result.replace("\n\n", "\n")
-        # result = first_to_second_person(result)
-        if self.censor:
-            result = remove_profanity(result)
-
-        if not first_letter_capitalized:
-            result = result[0].lower() + result[1:]
-
-        #
-        # print("\n\nAFTER RESULT_REPLACE:")
-        # print(repr(result))
-
-        return result
-
-    def generate_raw(self, prompt):
-        context_tokens = self.enc.encode(prompt)
-        generated = 0
-        for _ in range(self.samples // self.batch_size):
-            out = self.sess.run(
-                self.output,
-                feed_dict={
-                    self.context: [context_tokens for _ in range(self.batch_size)]
-                },
-            )[:, len(context_tokens) :]
-            for i in range(self.batch_size):
-                generated += 1
-                text = self.enc.decode(out[i])
-        return text
+        export = self.load_export() if use_export else None
+        self.from_export = export is not None
+        with self.graph.as_default():
+            if self.from_export:
+                self.import_graph(export)
+            else:
+                self.build_graph()
+            if share_weights:
+                if not weight_store.exists(self.checkpoint_path):
+                    raise FileNotFoundError(
+                        "share_weights needs the weight store written by "
+                        "python -m generator.gpt2.export_sampler"
+                    )
+                weights = weight_store.load(self.checkpoint_path)
+                self.weight_feed = {
+                    placeholder: weights[name]
+                    for name, placeholder in self.weight_inputs.items()
+                }
+            elif self.from_export:
+                self.load_weights(weight_store.load(self.checkpoint_path))
+            else:
+                saver = tf.train.Saver()
+                ckpt = tf.train.latest_checkpoint(self.checkpoint_path)
+                saver.restore(self.sess, ckpt)
+
+    def weight_input(self, getter, name, *args, shape=None, dtype=None, **kwargs):
+        """Custom getter that puts a placeholder where a variable would go."""
+        if name not in self.weight_inputs:
+            # Outside the sampling loop, like a variable would be
+            with tf.init_scope():
+                self.weight_inputs[name] = tf.placeholder(dtype, shape)
+        return self.weight_inputs[name]
+
+    def build_graph(self):
+        hparams = self.hparams
+        # Batch size is left open so several prompts can share one run
+        self.context = tf.placeholder(tf.int32, [None, None])
+        # Tokens a story's cache already covers and their keys and values
+        self.history = tf.placeholder(tf.int32, [None, None])
+        self.past = tf.placeholder(tf.float32, model.past_shape(hparams=hparams))
+        # How many tokens of left padding each row has
+        self.pads = tf.placeholder(tf.int32, [None])
+        # Which stream (if any) each row's tokens are reported to, 0 for none
+        self.stream_keys = tf.placeholder(tf.int64, [None])
+        # Sampling is stateless, drawing from this and each step's position
+        self.seed = tf.placeholder(tf.int64, [2])
+        # One value of each sampling setting per row, so rows with different
+        # settings still share a run
+        self.settings = {
+            "generate_num": tf.placeholder(tf.int32, [None]),
+            "temperature": tf.placeholder(tf.float32, [None]),
+            "top_k": tf.placeholder(tf.int32, [None]),
+            "top_p": tf.placeholder(tf.float32, [None]),
+            "repetition_penalty": tf.placeholder(tf.float32, [None]),
+        }
+        stop_tokens, stop_sequences = self.stop_tokens(self.stop_strings)
+        getter = self.weight_input if self.share_weights else None
+        with tf.variable_scope(tf.get_variable_scope(), custom_getter=getter):
+            self.output, self.presents, self.lengths = sample.sample_sequence(
+                hparams=hparams,
+                length=self.settings["generate_num"],
+                context=self.context,
+                past=self.past,
+                history=self.history,
+                temperature=self.settings["temperature"],
+                top_k=self.settings["top_k"],
+                top_p=self.settings["top_p"],
+                penalty=self.settings["repetition_penalty"],
+                stop_tokens=stop_tokens,
+                stop_sequences=stop_sequences,
+                min_length=self.min_length,
+                callback=self.on_sample,
+                callback_inputs=[self.stream_keys],
+                # A buffer with room for the whole run holds no more than the
+                # keys and values of its last step would, and saves a copy of
+                # every key and value each step
+                preallocate=self.preallocate_past,
+                pads=self.pads,
+                seed=self.seed,
+            )
+
+    def graph_options(self):
+        """The options that are built into the sampling graph."""
+        return {
+            "stop_strings": list(self.stop_strings or []),
+            "min_length": self.min_length,
+            "preallocate_past": self.preallocate_past,
+            "share_weights": self.share_weights,
+        }
+
+    def checkpoint_fingerprint(self):
+        """Identifies the checkpoint's weights, or None if there isn't one.
 
-    def generate(self, prompt, options=None, seed=1):
+        The checkpoint's index holds a checksum of every variable, so it
+        changes with them without reading the weights themselves.
+        """
+        ckpt = tf.train.latest_checkpoint(self.checkpoint_path)
+        if ckpt is None:
+            return None
+        hparams = os.path.join(self.checkpoint_path, "hparams.json")
+        return fingerprint([ckpt + ".index", hparams])
 
-        debug_print = False
-        prompt = self.prompt_replace(prompt)
+    def export(self):
+        """Save the sampling graph for later generators to load, and the
+        weights too unless they're already fed from the weight store."""
+        with self.graph.as_default():
+            tf.train.export_meta_graph(
+                filename=os.path.join(self.checkpoint_path, EXPORT_GRAPH),
+                clear_devices=True,
+            )
+            if not self.share_weights:
+                variables = tf.global_variables()
+                values = self.sess.run(variables)
+                weight_store.save(
+                    self.checkpoint_path,
+                    {v.op.name: value for v, value in zip(variables, values)},
+                )
+        tensors = {name: getattr(self, name).name for name in self.tensor_names}
+        tensors["settings"] = {
+            name: placeholder.name for name, placeholder in self.settings.items()
+        }
+        tensors["weights"] = {
+            name: placeholder.name for name, placeholder in self.weight_inputs.items()
+        }
+        with open(os.path.join(self.checkpoint_path, EXPORT_INDEX), "w") as f:
+            json.dump(
+                {
+                    "options": self.graph_options(),
+                    "checkpoint": self.checkpoint_fingerprint(),
+                    "graph": fingerprint(GRAPH_SOURCES),
+                    "tensors": tensors,
+                },
+                f,
+            )
+
+    def load_export(self):
+        """The export's index, or None if there isn't one for these options,
+        this checkpoint and this version of the graph."""
+        path = os.path.join(self.checkpoint_path, EXPORT_INDEX)
+        if not os.path.exists(path) or not weight_store.exists(self.checkpoint_path):
+            return None
+        with open(path) as f:
+            export = json.load(f)
+        if export["options"] != self.graph_options():
+            print("Exported graph was made with other options, building a new one")
+            return None
+        # Without a checkpoint, the export is all there is
+        checkpoint = self.checkpoint_fingerprint()
+        if checkpoint is not None and export.get("checkpoint") != checkpoint:
+            if self.share_weights:
+                # The weight store was written with the export
+                raise ValueError(
+                    "The weight store is from another checkpoint, export it "
+                    "again with python -m generator.gpt2.export_sampler"
+                )
+            print("Exported graph is from another checkpoint, building a new one")
+            return None
+        if export.get("graph") != fingerprint(GRAPH_SOURCES):
+            print("Exported graph is from other code, building a new one")
+            return None
+        return export
 
-        if debug_print:
-            print("******DEBUG******")
-            print("Prompt is: ", repr(prompt))
+    def import_graph(self, export):
+        meta_graph = tf.compat.v1.MetaGraphDef()
+        with open(os.path.join(self.checkpoint_path, EXPORT_GRAPH), "rb") as f:
+            meta_graph.ParseFromString(f.read())
+        # A py_func only refers to its function by a token from this process's
+        # registry, so on_sample is registered again and the exported
+        # callback pointed at it
+        registered = tf.py_func(self.on_sample, [], tf.bool, name="on_sample")
+        token = registered.op.get_attr("token")
+        for node in meta_graph.graph_def.node:
+            if node.op == "PyFunc":
+                node.attr["token"].s = token
+        tf.train.import_meta_graph(meta_graph, clear_devices=True)
 
-        text = self.generate_raw(prompt)
+        tensors = export["tensors"]
+        for name in self.tensor_names:
+            setattr(self, name, self.graph.get_tensor_by_name(tensors[name]))
+        self.settings = {
+            name: self.graph.get_tensor_by_name(tensor)
+            for name, tensor in tensors["settings"].items()
+        }
+        self.weight_inputs = {
+            name: self.graph.get_tensor_by_name(tensor)
+            for name, tensor in tensors["weights"].items()
+        }
 
-        if debug_print:
-            print("Generated result is: ", repr(text))
-            print("******END DEBUG******")
+    def load_weights(self, weights):
+        # Each variable's initializer is fed its value, so loading doesn't
+        # add anything to the graph
+        variables = tf.global_variables()
+        self.sess.run(
+            [v.initializer for v in variables],
+            {v.initializer.inputs[1]: weights[v.op.name] for v in variables},
+        )
 
-        result = text
-        result = self.result_replace(result)
-        if len(result) == 0:
-            return self.generate(prompt)
+    def load_hparams(self, path):
+        hparams = model.default_hparams()
+        with open(path) as f:
+            hparams.override_from_dict(json.load(f))
+        return hparams
 
-        return result
+    def run_batch(
+        self, history, context, past, pads, stream_keys, settings, caches=None
+    ):
+        feed_dict = {
+            self.history: history,
+            self.context: context,
+            self.past: past,
+            self.pads: pads,
+            self.stream_keys: stream_keys,
+            self.seed: np.random.randint(0, 2 ** 31 - 1, size=2),
+        }
+        feed_dict.update(self.weight_feed)
+        for name, placeholder in self.settings.items():
+            feed_dict[placeholder] = settings[name]
+        return self.sess.run(
+            [self.output, self.presents, self.lengths], feed_dict=feed_dict
+        )
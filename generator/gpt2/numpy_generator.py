@@ -0,0 +1,95 @@
+import os
+
+import numpy as np
+
+from generator.gpt2 import weight_store
+from generator.gpt2.generator_base import GeneratorBase
+from generator.gpt2.src import numpy_model, numpy_sample, numpy_speculative
+
+
+class NumpyGPT2Generator(GeneratorBase):
+    """Runs the model in NumPy, without TensorFlow.
+
+    It needs the model's weights exported to weights.npz by
+    generator/gpt2/export_numpy.py, and starts much faster than building and
+    restoring the TensorFlow graph, though each step is slower. If
+    generator/gpt2/export_sampler.py has written a weight store it's used
+    instead, and float32 weights are read straight from the mapped file, so
+    processes running the same model share them.
+
+    With a draft_model_name (a smaller GPT-2 with the same vocabulary, like
+    124M from download_model.py, exported the same way), the draft proposes
+    up to lookahead tokens at a time and the model checks them in one run.
+    The results are sampled from exactly the same distribution. The draft's
+    keys and values are kept in stories' caches too. drafted and kept count
+    how many tokens the draft proposed and how many were used.
+    """
+
+    def __init__(self, *args, draft_model_name=None, lookahead=4, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.model = self.load_model(self.model_name, self.hparams)
+        self.draft = None
+        if draft_model_name is not None:
+            hparams = self.load_hparams(
+                os.path.join(self.model_dir, draft_model_name, "hparams.json")
+            )
+            if hparams.n_vocab != self.hparams.n_vocab:
+                raise ValueError(
+                    "%s doesn't have the same vocabulary as %s"
+                    % (draft_model_name, self.model_name)
+                )
+            self.draft = self.load_model(draft_model_name, hparams)
+        self.lookahead = lookahead
+        self.drafted = 0
+        self.kept = 0
+        self.stop_token_ids, self.stop_sequences = self.stop_tokens(
+            self.stop_strings
+        )
+
+    def load_model(self, model_name, hparams):
+        path = os.path.join(self.model_dir, model_name)
+        if weight_store.exists(path):
+            weights = numpy_model.dequantize(weight_store.load(path))
+        else:
+            weights = numpy_model.load_weights(os.path.join(path, "weights.npz"))
+        return numpy_model.Model(hparams, weights)
+
+    def run_batch(
+        self, history, context, past, pads, stream_keys, settings, caches=None
+    ):
+        rows = len(context)
+        arguments = dict(
+            model=self.model,
+            length=np.array(settings["generate_num"]),
+            context=np.array(context, dtype=np.int64).reshape(rows, -1),
+            past=past,
+            history=np.array(history, dtype=np.int64).reshape(rows, -1),
+            pads=np.array(pads),
+            temperature=np.array(settings["temperature"], dtype=np.float32),
+            top_k=np.array(settings["top_k"]),
+            top_p=np.array(settings["top_p"], dtype=np.float32),
+            penalty=np.array(settings["repetition_penalty"], dtype=np.float32),
+            stop_tokens=self.stop_token_ids,
+            stop_sequences=self.stop_sequences,
+            min_length=self.min_length,
+        )
+        if self.draft is None:
+
+            def callback(samples, done):
+                self.on_sample(stream_keys, samples, done)
+
+            return numpy_sample.sample_sequence(callback=callback, **arguments)
+
+        def callback(row, token, done):
+            self.on_sample([stream_keys[row]], np.array([[token]]), [done])
+
+        out, presents, lengths, drafted, kept = numpy_speculative.sample_sequence(
+            draft=self.draft,
+            lookahead=self.lookahead,
+            caches=caches,
+            callback=callback,
+            **arguments
+        )
+        self.drafted += drafted
+        self.kept += kept
+        return out, presents, lengths
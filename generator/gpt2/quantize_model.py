@@ -0,0 +1,105 @@
+"""Convert a model's checkpoint to store its weight matrices as int8 or float16.
+
+The weight matrices (every conv1d and the token embedding) are converted and
+everything else is copied as it is. The model reads the new format from
+weight_dtype in its hparams.json and does its math in float32 either way.
+That saves memory, not time: each weight is cast back to float32 on every
+step, which makes generating slower. Run from the top of the repository:
+
+    python -m generator.gpt2.quantize_model model_v5 model_v5_int8 --dtype int8
+
+Then use the new model with GPT2Generator(model_name="model_v5_int8"), and
+check it with generator.gpt2.compare_models and generator.gpt2.benchmark.
+"""
+import argparse
+import json
+import os
+import shutil
+
+import numpy as np
+
+import tensorflow as tf
+
+
+def quantization_axis(name):
+    """Axis int8 scales are taken along for a variable, or None to keep it."""
+    if name.endswith("/w"):
+        # conv1d weights are [1, nx, nf], and each output column gets a scale
+        return -1
+    if name.endswith("/wte"):
+        # One scale per token, so embedding lookups only need their own
+        return 0
+    return None
+
+
+def quantize(value, dtype, axis):
+    """Returns the converted value and, for int8, its float32 scales."""
+    if dtype == "float16":
+        return value.astype(np.float16), None
+    # Symmetric: each slice along axis is divided by its largest magnitude
+    # over 127 and rounded
+    axis = axis % value.ndim
+    others = tuple(i for i in range(value.ndim) if i != axis)
+    scale = np.abs(value).max(axis=others) / 127
+    scale[scale == 0] = 1
+    shape = [1] * value.ndim
+    shape[axis] = -1
+    quantized = np.clip(np.round(value / scale.reshape(shape)), -127, 127)
+    return quantized.astype(np.int8), scale.astype(np.float32)
+
+
+def convert(source, destination, dtype):
+    os.makedirs(destination, exist_ok=True)
+    for name in ["encoder.json", "vocab.bpe"]:
+        shutil.copy(os.path.join(source, name), os.path.join(destination, name))
+    with open(os.path.join(source, "hparams.json")) as f:
+        hparams = json.load(f)
+    hparams["weight_dtype"] = dtype
+    with open(os.path.join(destination, "hparams.json"), "w") as f:
+        json.dump(hparams, f)
+
+    reader = tf.train.load_checkpoint(tf.train.latest_checkpoint(source))
+    before = after = 0
+    with tf.Graph().as_default(), tf.compat.v1.Session() as sess:
+        # Values go in through placeholders, since a 1.5B parameter model is
+        # far too big to put in the graph as constants
+        for name in sorted(reader.get_variable_to_shape_map()):
+            value = reader.get_tensor(name)
+            before += value.nbytes
+            axis = quantization_axis(name)
+            if axis is None:
+                values = {name: value}
+            else:
+                value, scale = quantize(value, dtype, axis)
+                values = {name: value}
+                if scale is not None:
+                    values[name + "_scale"] = scale
+            for stored_name, stored in values.items():
+                variable = tf.get_variable(
+                    stored_name, stored.shape, dtype=tf.as_dtype(stored.dtype)
+                )
+                placeholder = tf.placeholder(variable.dtype, stored.shape)
+                sess.run(variable.assign(placeholder), {placeholder: stored})
+                after += stored.nbytes
+            print("Converted", name)
+        saver = tf.train.Saver()
+        saver.save(sess, os.path.join(destination, "model"), write_meta_graph=False)
+    print("Weights went from %.1f MB to %.1f MB" % (before / 1e6, after / 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("source", help="model to convert, e.g. model_v5")
+    parser.add_argument("destination", help="name of the converted model")
+    parser.add_argument("--dtype", choices=["int8", "float16"], default="int8")
+    parser.add_argument("--models-dir", default="generator/gpt2/models")
+    args = parser.parse_args()
+    convert(
+        os.path.join(args.models_dir, args.source),
+        os.path.join(args.models_dir, args.destination),
+        args.dtype,
+    )
+
+
+if __name__ == "__main__":
+    main()
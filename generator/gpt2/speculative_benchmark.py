@@ -0,0 +1,96 @@
+"""Measure speculative decoding's acceptance rate and speed on recorded prompts.
+
+Every character's opening from story/story_data.yaml (or each line of the
+file given with --prompts) is sampled by NumpyGPT2Generator alone and then
+with the draft model at each lookahead. This reports how many of the drafted
+tokens were kept and how many tokens were sampled per second. Export both
+models with generator.gpt2.export_numpy first, then run from the top of the
+repository:
+
+    python -m generator.gpt2.speculative_benchmark --draft-model-name 124M
+"""
+import argparse
+import time
+
+import numpy as np
+import yaml
+
+from generator.gpt2.numpy_generator import NumpyGPT2Generator
+from story.utils import YAML_FILE
+
+
+def recorded_prompts():
+    """The opening of every character's story, the way play.py writes it."""
+    with open(YAML_FILE) as f:
+        data = yaml.safe_load(f)
+    prompts = []
+    for setting in data["settings"].values():
+        for key, character in setting["characters"].items():
+            context = "You are a %s %sYou have a %s and a %s. " % (
+                key,
+                setting["description"],
+                character["item1"],
+                character["item2"],
+            )
+            prompts.extend(context + prompt for prompt in character["prompts"])
+    return prompts
+
+
+def run(generator, prompts, seed):
+    """Tokens sampled per second over all the prompts."""
+    np.random.seed(seed)
+    sampled = 0
+    start = time.perf_counter()
+    for prompt in prompts:
+        context = generator.encode(prompt)
+        cache = {}
+        generator.sample_batch([context], [cache])
+        # The cache holds every token but the last one sampled
+        sampled += len(cache["tokens"]) + 1 - len(context)
+    return sampled / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model-name", default="model_v5")
+    parser.add_argument("--draft-model-name", default="124M")
+    parser.add_argument("--lookahead", type=int, nargs="+", default=[2, 4, 6])
+    parser.add_argument("--prompts", help="file with one prompt per line")
+    parser.add_argument("--generate-num", type=int, default=60)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.prompts is None:
+        prompts = recorded_prompts()
+    else:
+        with open(args.prompts) as f:
+            prompts = [line.strip() for line in f if line.strip()]
+    # Without stops every prompt samples generate_num tokens, so runs compare
+    kwargs = {
+        "model_name": args.model_name,
+        "generate_num": args.generate_num,
+        "stop_strings": (),
+    }
+
+    print("%d prompts, %d tokens each" % (len(prompts), args.generate_num))
+    print("%-12s %10s %10s" % ("lookahead", "kept", "tokens/s"))
+    baseline = run(NumpyGPT2Generator(**kwargs), prompts, args.seed)
+    print("%-12s %10s %10.1f" % ("none", "-", baseline))
+    for lookahead in args.lookahead:
+        generator = NumpyGPT2Generator(
+            draft_model_name=args.draft_model_name, lookahead=lookahead, **kwargs
+        )
+        speed = run(generator, prompts, args.seed)
+        print(
+            "%-12d %9.1f%% %10.1f  (%.2fx)"
+            % (
+                lookahead,
+                100 * generator.kept / max(generator.drafted, 1),
+                speed,
+                speed / baseline,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
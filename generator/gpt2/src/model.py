@@ -2,10 +2,18 @@ import numpy as np
 
 import tensorflow as tf
 from tensorflow.contrib.training import HParams
+from tensorflow.python.ops import inplace_ops
 
 
 def default_hparams():
-    return HParams(n_vocab=0, n_ctx=1024, n_embd=768, n_head=12, n_layer=12,)
+    return HParams(
+        n_vocab=0,
+        n_ctx=1024,
+        n_embd=768,
+        n_head=12,
+        n_layer=12,
+        weight_dtype="float32",
+    )
 
 
 def shape_list(x):
@@ -50,19 +58,49 @@ def merge_states(x):
     return tf.reshape(x, start + [a * b])
 
 
-def conv1d(x, scope, nf, *, w_init_stdev=0.02):
+def weight(name, shape, *, dtype, axis, initializer):
+    """A weight matrix stored as dtype ("float32", "float16" or "int8").
+
+    Returns the variable as it's stored and, for int8, the float32 scale of
+    each slice along axis (None otherwise). Cast it to float32 only after
+    slicing or gathering, and multiply the scale back in after any matmul,
+    so the work is done in float32 on as little as possible.
+    """
+    if dtype == "float32":
+        return tf.get_variable(name, shape, initializer=initializer), None
+    if dtype == "float16":
+        w = tf.get_variable(name, shape, dtype=tf.float16, initializer=initializer)
+        return w, None
+    if dtype == "int8":
+        # Only ever restored from a converted checkpoint
+        w = tf.get_variable(
+            name, shape, dtype=tf.int8, initializer=tf.zeros_initializer()
+        )
+        scale = tf.get_variable(
+            name + "_scale", [shape[axis]], initializer=tf.constant_initializer(1)
+        )
+        return w, scale
+    raise ValueError("Unknown weight_dtype " + repr(dtype))
+
+
+def conv1d(x, scope, nf, *, w_init_stdev=0.02, weight_dtype="float32"):
     with tf.variable_scope(scope):
         *start, nx = shape_list(x)
-        w = tf.get_variable(
+        w, scale = weight(
             "w",
             [1, nx, nf],
+            dtype=weight_dtype,
+            axis=-1,
             initializer=tf.random_normal_initializer(stddev=w_init_stdev),
         )
         b = tf.get_variable("b", [nf], initializer=tf.constant_initializer(0))
-        c = tf.reshape(
-            tf.matmul(tf.reshape(x, [-1, nx]), tf.reshape(w, [-1, nf])) + b,
-            start + [nf],
-        )
+        # There's no CPU matmul for int8 or float16 weights, so this cast
+        # runs on every step, and quantized models are slower
+        w = tf.cast(tf.reshape(w, [-1, nf]), tf.float32)
+        c = tf.matmul(tf.reshape(x, [-1, nx]), w)
+        if scale is not None:
+            c = c * scale
+        c = tf.reshape(c + b, start + [nf])
         return c
 
 
@@ -77,13 +115,56 @@ def attention_mask(nd, ns, *, dtype):
     return tf.cast(m, dtype)
 
 
-def attn(x, scope, n_state, *, past, hparams):
+def padding_mask(pads, ns, *, start=0, dtype):
+    """[batch, 1, 1, ns] with 1's for keys that aren't left padding.
+
+    Key j is at index start + j of its row, and each row's first pads are
+    padding.
+    """
+    m = start + tf.range(ns)[None, :] >= pads[:, None]
+    return tf.reshape(tf.cast(m, dtype), [-1, 1, 1, ns])
+
+
+def decode_bias(ns, *, past_length=None, pads=None, dtype):
+    """What to add to the scores of a single new token against ns past keys.
+
+    0 where it can attend and -1e10 for empty buffer slots and padding, or
+    None if it can attend to all of them.
+    """
+    blocked = None
+    if past_length is not None:
+        blocked = tf.range(ns)[None, :] >= past_length
+    if pads is not None:
+        padding = tf.range(ns)[None, :] < pads[:, None]
+        blocked = padding if blocked is None else blocked | padding
+    if blocked is None:
+        return None
+    return tf.reshape(tf.cast(blocked, dtype) * -1e10, [-1, 1, 1, ns])
+
+
+def attn(
+    x,
+    scope,
+    n_state,
+    *,
+    past,
+    hparams,
+    pads=None,
+    past_bias=None
+):
+    """Self-attention over the new tokens in x and the keys and values in past.
+
+    past is None or the keys and values before x, as a pair of
+    [batch, heads, sequence, features] tensors. If pads is given, each row's
+    first pads[row] tokens are padding that nothing attends to.
+
+    A single new token following past (a decoding step) needs no causal
+    mask, so it takes a faster path that only adds past_bias, the
+    decode_bias for past, to its scores. It's the only path that can be
+    given a preallocated buffer, with past_bias masking out its empty slots.
+    """
     assert x.shape.ndims == 3  # Should be [batch, sequence, features]
     assert n_state % hparams.n_head == 0
-    if past is not None:
-        assert (
-            past.shape.ndims == 5
-        )  # Should be [batch, 2, heads, sequence, features], where 2 is [k, v]
 
     def split_heads(x):
         # From [batch, sequence, features] to [batch, heads, sequence, features]
@@ -98,6 +179,8 @@ def attn(x, scope, n_state, *, past, hparams):
         _, _, nd, ns = shape_list(w)
         b = attention_mask(nd, ns, dtype=w.dtype)
         b = tf.reshape(b, [1, 1, nd, ns])
+        if pads is not None:
+            b = b * padding_mask(pads, ns, dtype=w.dtype)
         w = w * b - tf.cast(1e10, w.dtype) * (1 - b)
         return w
 
@@ -111,32 +194,55 @@ def attn(x, scope, n_state, *, past, hparams):
         a = tf.matmul(w, v)
         return a
 
+    def decode_attn(q, k, v, pk, pv):
+        # The new token attends to itself and past, so the only masking is
+        # the bias, and its own score is a dot product rather than a matmul
+        scale = tf.rsqrt(tf.cast(v.shape[-1].value, q.dtype))
+        w_past = tf.matmul(q, pk, transpose_b=True) * scale
+        if past_bias is not None:
+            w_past = w_past + past_bias
+        w_new = tf.reduce_sum(q * k, axis=-1, keepdims=True) * scale
+        w = softmax(tf.concat([w_past, w_new], axis=-1))
+        w_past, w_new = tf.split(w, [tf.shape(pk)[-2], 1], axis=-1)
+        return tf.matmul(w_past, pv) + w_new * v
+
     with tf.variable_scope(scope):
-        c = conv1d(x, "c_attn", n_state * 3)
+        c = conv1d(x, "c_attn", n_state * 3, weight_dtype=hparams.weight_dtype)
         q, k, v = map(split_heads, tf.split(c, 3, axis=2))
         present = tf.stack([k, v], axis=1)
-        if past is not None:
-            pk, pv = tf.unstack(past, axis=1)
-            k = tf.concat([pk, k], axis=-2)
-            v = tf.concat([pv, v], axis=-2)
-        a = multihead_attn(q, k, v)
+        if past is not None and x.shape[1].value == 1:
+            a = decode_attn(q, k, v, *past)
+        else:
+            if past is not None:
+                pk, pv = past
+                k = tf.concat([pk, k], axis=-2)
+                v = tf.concat([pv, v], axis=-2)
+            a = multihead_attn(q, k, v)
         a = merge_heads(a)
-        a = conv1d(a, "c_proj", n_state)
+        a = conv1d(a, "c_proj", n_state, weight_dtype=hparams.weight_dtype)
         return a, present
 
 
 def mlp(x, scope, n_state, *, hparams):
     with tf.variable_scope(scope):
         nx = x.shape[-1].value
-        h = gelu(conv1d(x, "c_fc", n_state))
-        h2 = conv1d(h, "c_proj", nx)
+        h = gelu(conv1d(x, "c_fc", n_state, weight_dtype=hparams.weight_dtype))
+        h2 = conv1d(h, "c_proj", nx, weight_dtype=hparams.weight_dtype)
         return h2
 
 
-def block(x, scope, *, past, hparams):
+def block(x, scope, *, past, hparams, pads=None, past_bias=None):
     with tf.variable_scope(scope):
         nx = x.shape[-1].value
-        a, present = attn(norm(x, "ln_1"), "attn", nx, past=past, hparams=hparams)
+        a, present = attn(
+            norm(x, "ln_1"),
+            "attn",
+            nx,
+            past=past,
+            hparams=hparams,
+            pads=pads,
+            past_bias=past_bias,
+        )
         x = x + a
         m = mlp(norm(x, "ln_2"), "mlp", nx * 4, hparams=hparams)
         x = x + m
@@ -154,6 +260,68 @@ def past_shape(*, hparams, batch_size=None, sequence=None):
     ]
 
 
+def buffer_shape(*, hparams, batch_size=None, sequence=None):
+    """past_shape for a preallocated buffer, which is layer-major.
+
+    Taking a layer's keys or values from the front of a buffer is a slice
+    that shares its memory, while taking them from any other axis (like
+    past_shape's) copies them, so every decoding step would copy the whole
+    buffer.
+    """
+    return [
+        hparams.n_layer,
+        2,
+        batch_size,
+        hparams.n_head,
+        sequence,
+        hparams.n_embd // hparams.n_head,
+    ]
+
+
+def to_buffer(past):
+    """From the layout of past_shape to that of buffer_shape."""
+    return tf.transpose(past, [1, 2, 0, 3, 4, 5])
+
+
+def from_buffer(buffer):
+    """From the layout of buffer_shape to that of past_shape."""
+    return tf.transpose(buffer, [2, 0, 1, 3, 4, 5])
+
+
+def write_past(buffer, presents, past_length):
+    """Write presents into a preallocated buffer from position past_length.
+
+    presents has the layout of past_shape and buffer that of buffer_shape,
+    with room for every position that will be written.
+
+    The buffer's memory is written to in place, since copying it would cost
+    as much as the rest of a decoding step once it's long. So it has to be a
+    buffer only the caller holds, and everything reading it before the write
+    has to have run first (by a control dependency).
+    """
+    presents = to_buffer(presents)
+    layers, kv, batch, heads, buffered, size = shape_list(buffer)
+    sequence = shape_list(presents)[4]
+    # The buffer as rows of size values, and the row of every value written
+    position = tf.meshgrid(
+        tf.range(layers),
+        tf.range(kv),
+        tf.range(batch),
+        tf.range(heads),
+        past_length + tf.range(sequence),
+        indexing="ij",
+    )
+    row = position[0]
+    for axis, count in zip(position[1:], [kv, batch, heads, buffered]):
+        row = row * count + axis
+    rows = inplace_ops.alias_inplace_update(
+        tf.reshape(buffer, [-1, size]),
+        tf.reshape(row, [-1]),
+        tf.reshape(presents, [-1, size]),
+    )
+    return tf.reshape(rows, shape_list(buffer))
+
+
 def expand_tile(value, size):
     """Add a new axis of given size."""
     value = tf.convert_to_tensor(value, name="value")
@@ -161,13 +329,34 @@ def expand_tile(value, size):
     return tf.tile(tf.expand_dims(value, axis=0), [size] + [1] * ndims)
 
 
-def positions_for(tokens, past_length):
+def positions_for(tokens, past_length, pads=None):
     batch_size = tf.shape(tokens)[0]
     nsteps = tf.shape(tokens)[1]
-    return expand_tile(past_length + tf.range(nsteps), batch_size)
-
-
-def model(hparams, X, past=None, scope="model", reuse=False):
+    positions = expand_tile(past_length + tf.range(nsteps), batch_size)
+    if pads is None:
+        return positions
+    # Each row counts from its first real token. Padding gets position 0,
+    # which nothing looks at.
+    return tf.maximum(positions - pads[:, None], 0)
+
+
+def model(
+    hparams, X, past=None, scope="model", reuse=False, past_length=None, pads=None
+):
+    """Run the model on X following the keys and values in past.
+
+    past is either exactly the past tokens' keys and values, in the layout
+    of past_shape, or (when past_length is given) a preallocated buffer in
+    the layout of buffer_shape holding them in its first past_length
+    positions. A buffer can only be given with X one token long. "present"
+    is always just X's keys and values, in the layout of past_shape.
+
+    pads is how many tokens each row is left padded by (counting from the
+    start of past), so rows of different lengths can share a batch.
+
+    When X is statically one token long and follows past, every layer takes
+    the decoding path in attn, sharing one mask built here.
+    """
     with tf.variable_scope(scope, reuse=reuse):
         results = {}
         batch, sequence = shape_list(X)
@@ -177,29 +366,57 @@ def model(hparams, X, past=None, scope="model", reuse=False):
             [hparams.n_ctx, hparams.n_embd],
             initializer=tf.random_normal_initializer(stddev=0.01),
         )
-        wte = tf.get_variable(
+        wte, wte_scale = weight(
             "wte",
             [hparams.n_vocab, hparams.n_embd],
+            dtype=hparams.weight_dtype,
+            axis=0,
             initializer=tf.random_normal_initializer(stddev=0.02),
         )
-        past_length = 0 if past is None else tf.shape(past)[-2]
-        h = tf.gather(wte, X) + tf.gather(wpe, positions_for(X, past_length))
+        if past_length is not None:
+            position = past_length
+        else:
+            position = 0 if past is None else tf.shape(past)[-2]
+        embeddings = tf.cast(tf.gather(wte, X), tf.float32)
+        if wte_scale is not None:
+            embeddings = embeddings * tf.gather(wte_scale, X)[:, :, tf.newaxis]
+        h = embeddings + tf.gather(wpe, positions_for(X, position, pads))
+
+        past_bias = None
+        if past is not None and X.shape[1].value == 1:
+            past_bias = decode_bias(
+                tf.shape(past)[-2], past_length=past_length, pads=pads, dtype=h.dtype
+            )
 
         # Transformer
         presents = []
-        pasts = (
-            tf.unstack(past, axis=1) if past is not None else [None] * hparams.n_layer
-        )
+        if past is None:
+            pasts = [None] * hparams.n_layer
+        elif past_length is not None:
+            assert X.shape[1].value == 1, "A buffer can only be decoded into"
+            # Slices along the first axis, which don't copy
+            pasts = [tf.unstack(layer, axis=0) for layer in tf.unstack(past, axis=0)]
+        else:
+            pasts = [tf.unstack(layer, axis=1) for layer in tf.unstack(past, axis=1)]
         assert len(pasts) == hparams.n_layer
         for layer, past in enumerate(pasts):
-            h, present = block(h, "h%d" % layer, past=past, hparams=hparams)
+            h, present = block(
+                h,
+                "h%d" % layer,
+                past=past,
+                hparams=hparams,
+                pads=pads,
+                past_bias=past_bias,
+            )
             presents.append(present)
         results["present"] = tf.stack(presents, axis=1)
         h = norm(h, "ln_f")
 
         # Language model loss.  Do tokens <n predict token n?
         h_flat = tf.reshape(h, [batch * sequence, hparams.n_embd])
-        logits = tf.matmul(h_flat, wte, transpose_b=True)
+        logits = tf.matmul(h_flat, tf.cast(wte, tf.float32), transpose_b=True)
+        if wte_scale is not None:
+            logits = logits * wte_scale
         logits = tf.reshape(logits, [batch, sequence, hparams.n_vocab])
         results["logits"] = logits
         return results
@@ -0,0 +1,144 @@
+"""The GPT-2 forward pass in NumPy, for running without TensorFlow.
+
+Weights come from an .npz written by generator/gpt2/export_numpy.py or a
+weight store written by generator/gpt2/export_sampler.py, with the same
+names as the checkpoint's variables. Keys and values live in one
+preallocated array per run, laid out like model.past_shape.
+"""
+import numpy as np
+
+
+def softmax(x, axis=-1):
+    x = x - np.max(x, axis=axis, keepdims=True)
+    ex = np.exp(x)
+    return ex / np.sum(ex, axis=axis, keepdims=True)
+
+
+def gelu(x):
+    return 0.5 * x * (1 + np.tanh(np.sqrt(2 / np.pi) * (x + 0.044715 * x ** 3)))
+
+
+def norm(x, g, b, epsilon=1e-5):
+    u = np.mean(x, axis=-1, keepdims=True)
+    s = np.mean(np.square(x - u), axis=-1, keepdims=True)
+    return (x - u) / np.sqrt(s + epsilon) * g + b
+
+
+def load_weights(path):
+    """float32 arrays by variable name from an .npz."""
+    with np.load(path) as stored:
+        return dequantize({name: stored[name] for name in stored.files})
+
+
+def dequantize(stored):
+    """float32 arrays by variable name, with int8 weights scaled back up.
+
+    float32 arrays are used as they are, so ones mapped from a weight store
+    stay mapped instead of being copied.
+    """
+    weights = {}
+    for name, value in stored.items():
+        if name.endswith("_scale"):
+            continue
+        if value.dtype == np.int8:
+            scale = stored[name + "_scale"]
+            # conv1d weights are scaled per column and wte per token
+            axis = 0 if name.endswith("/wte") else -1
+            shape = [1] * value.ndim
+            shape[axis] = -1
+            value = value * scale.reshape(shape)
+        weights[name] = value.astype(np.float32, copy=False)
+    return weights
+
+
+class Model:
+    def __init__(self, hparams, weights):
+        self.hparams = hparams
+        self.wte = weights["model/wte"]
+        self.wpe = weights["model/wpe"]
+        self.ln_f = (weights["model/ln_f/g"], weights["model/ln_f/b"])
+        self.layers = []
+        for layer in range(hparams.n_layer):
+
+            def get(name, layer=layer):
+                return weights["model/h%d/%s" % (layer, name)]
+
+            self.layers.append(
+                {
+                    "ln_1": (get("ln_1/g"), get("ln_1/b")),
+                    # conv1d weights are [1, nx, nf]
+                    "c_attn": (get("attn/c_attn/w")[0], get("attn/c_attn/b")),
+                    "attn_proj": (get("attn/c_proj/w")[0], get("attn/c_proj/b")),
+                    "ln_2": (get("ln_2/g"), get("ln_2/b")),
+                    "c_fc": (get("mlp/c_fc/w")[0], get("mlp/c_fc/b")),
+                    "mlp_proj": (get("mlp/c_proj/w")[0], get("mlp/c_proj/b")),
+                }
+            )
+
+    def past_buffer(self, batch_size, sequence):
+        hparams = self.hparams
+        return np.zeros(
+            [
+                batch_size,
+                hparams.n_layer,
+                2,
+                hparams.n_head,
+                sequence,
+                hparams.n_embd // hparams.n_head,
+            ],
+            dtype=np.float32,
+        )
+
+    def forward(self, tokens, past, past_length, pads, every_position=False):
+        """Run tokens ([batch, sequence]) following past_length tokens whose
+        keys and values are in the buffer past.
+
+        Their keys and values are written into past after the others, and
+        the logits for each row's last token are returned, or for all of its
+        tokens with every_position. Each row's first pads[row] tokens
+        (counting from the start of past) are padding.
+        """
+        hparams = self.hparams
+        batch, sequence = tokens.shape
+        heads = hparams.n_head
+        end = past_length + sequence
+
+        index = past_length + np.arange(sequence)
+        positions = np.maximum(index[None, :] - pads[:, None], 0)
+        h = self.wte[tokens] + self.wpe[positions]
+
+        # [batch, 1, sequence, keys]: causal, and nothing attends to padding
+        keys = np.arange(end)
+        mask = (keys[None, :] <= index[:, None])[None, :, :] & (
+            keys[None, None, :] >= pads[:, None, None]
+        )
+        bias = np.where(mask, 0, -1e10).astype(np.float32)[:, None, :, :]
+
+        def split_heads(x):
+            return x.reshape(batch, sequence, heads, -1).transpose(0, 2, 1, 3)
+
+        for layer, weights in enumerate(self.layers):
+            x = norm(h, *weights["ln_1"])
+            w, b = weights["c_attn"]
+            q, k, v = np.split(np.matmul(x, w) + b, 3, axis=-1)
+            past[:, layer, 0, :, past_length:end] = split_heads(k)
+            past[:, layer, 1, :, past_length:end] = split_heads(v)
+            q = split_heads(q)
+            k = past[:, layer, 0, :, :end]
+            v = past[:, layer, 1, :, :end]
+            scores = np.matmul(q, k.transpose(0, 1, 3, 2)) / np.sqrt(q.shape[-1])
+            a = np.matmul(softmax(scores + bias), v)
+            a = a.transpose(0, 2, 1, 3).reshape(batch, sequence, -1)
+            w, b = weights["attn_proj"]
+            h = h + np.matmul(a, w) + b
+
+            x = norm(h, *weights["ln_2"])
+            w, b = weights["c_fc"]
+            x = gelu(np.matmul(x, w) + b)
+            w, b = weights["mlp_proj"]
+            h = h + np.matmul(x, w) + b
+
+        if not every_position:
+            # Only the last token's logits are needed to sample from
+            h = h[:, -1]
+        return np.matmul(norm(h, *self.ln_f), self.wte.T)
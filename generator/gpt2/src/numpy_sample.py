@@ -0,0 +1,98 @@
+"""sample.sample_sequence for numpy_model, without TensorFlow."""
+import numpy as np
+
+from generator.gpt2.src.numpy_model import softmax
+
+
+def sample_top_k_top_p(logits, k, p):
+    """Sample a token per row from its top k[row] logits after nucleus
+    filtering with p[row]. A k of 0 means no truncation."""
+    batch, n_vocab = logits.shape
+    k = np.where(k > 0, k, n_vocab)
+    widest = int(k.max())
+    indices = np.argpartition(-logits, widest - 1, axis=-1)[:, :widest]
+    values = np.take_along_axis(logits, indices, axis=-1)
+    order = np.argsort(-values, axis=-1)
+    indices = np.take_along_axis(indices, order, axis=-1)
+    values = np.take_along_axis(values, order, axis=-1)
+    values[np.arange(widest)[None, :] >= k[:, None]] = -1e10
+
+    # Keep the smallest prefix whose probability reaches p, and at least one
+    cumulative = np.cumsum(softmax(values), axis=-1)
+    kept = np.maximum(np.sum(cumulative <= p[:, None], axis=-1), 1)
+    values[np.arange(widest)[None, :] >= kept[:, None]] = -1e10
+
+    cumulative = np.cumsum(softmax(values), axis=-1)
+    draws = np.random.random_sample([batch, 1]) * cumulative[:, -1:]
+    choices = np.minimum(np.sum(cumulative < draws, axis=-1), widest - 1)
+    return indices[np.arange(batch), choices]
+
+
+def stopped(output, samples, stop_tokens, stop_sequences):
+    hit = np.isin(samples, stop_tokens)
+    for sequence in stop_sequences:
+        if output.shape[1] >= len(sequence):
+            hit |= np.all(output[:, -len(sequence) :] == sequence, axis=-1)
+    return hit
+
+
+def sample_sequence(
+    *,
+    model,
+    length,
+    context,
+    past,
+    history,
+    pads,
+    temperature,
+    top_k,
+    top_p,
+    penalty,
+    stop_tokens=(),
+    stop_sequences=(),
+    min_length=0,
+    callback=None
+):
+    """Same as sample.sample_sequence, with every setting given per row.
+
+    history and context are [batch, sequence] arrays and past holds the
+    keys and values for history. callback is called as callback(samples,
+    done) after each step. Returns the tokens, their keys and values (but
+    the last sample's) and how many tokens each row sampled.
+    """
+    batch = context.shape[0]
+    output = np.concatenate([history, context], axis=1)
+    past_length = history.shape[1]
+    # Every position the run will reach, so keys and values are written in
+    # place instead of being copied onto the end of the ones before
+    buffer = model.past_buffer(batch, output.shape[1] + int(length.max()) - 1)
+    buffer[:, :, :, :, :past_length] = past
+
+    n_vocab = model.hparams.n_vocab
+    used = np.zeros([batch, n_vocab], dtype=bool)
+    real = np.arange(output.shape[1])[None, :] >= pads[:, None]
+    used[np.nonzero(real)[0], output[real]] = True
+    done = np.zeros([batch], dtype=bool)
+    lengths = np.zeros([batch], dtype=np.int32)
+
+    tokens = context
+    for _ in range(int(length.max())):
+        logits = model.forward(tokens, buffer, past_length, pads)
+        past_length += tokens.shape[1]
+        logits = logits / temperature[:, None]
+        logits = np.where(used, logits * penalty[:, None], logits)
+        samples = sample_top_k_top_p(logits, top_k, top_p)
+        output = np.concatenate([output, samples[:, None]], axis=1)
+        used[np.arange(batch), samples] = True
+        # Rows that have stopped keep sampling but stop counting, like the
+        # TensorFlow version
+        lengths += ~done
+        hit = stopped(output, samples, stop_tokens, stop_sequences)
+        done |= (hit & (lengths > min_length)) | (lengths >= length)
+        if callback is not None:
+            callback(samples[:, None], done)
+        if done.all():
+            break
+        tokens = samples[:, None]
+
+    return output, buffer[:, :, :, :, : output.shape[1] - 1], lengths
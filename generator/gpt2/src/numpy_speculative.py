@@ -0,0 +1,229 @@
+"""numpy_sample.sample_sequence with a small draft model proposing tokens.
+
+Each step the draft model samples up to lookahead tokens one at a time, and
+the model runs them all in one forward pass. Each drafted token is kept with
+probability min(1, p / q), where p and q are the model's and the draft's
+probabilities for it after the same temperature, penalty and top-k/top-p.
+The first one that isn't kept is replaced by a sample from max(0, p - q),
+normalized, and if all of them are kept one more token is sampled from the
+model. Every token then has exactly the distribution it would have had if
+the model had sampled it alone (Leviathan et al., 2023, "Fast Inference from
+Transformers via Speculative Decoding"), but the model runs once for several
+tokens.
+
+The draft's keys and values are kept in the story's cache, like the model's,
+so a turn only runs the draft over what it hasn't seen.
+"""
+import numpy as np
+
+from generator.gpt2.src.numpy_model import softmax
+
+
+def probabilities(logits, k, p):
+    """The distribution numpy_sample.sample_top_k_top_p draws a row from."""
+    n_vocab = logits.shape[-1]
+    k = k if k > 0 else n_vocab
+    indices = np.argpartition(-logits, k - 1)[:k]
+    values = logits[indices]
+    order = np.argsort(-values)
+    indices = indices[order]
+    values = values[order]
+    # Keep the smallest prefix whose probability reaches p, and at least one
+    kept = max(np.sum(np.cumsum(softmax(values)) <= p), 1)
+    result = np.zeros(n_vocab)
+    result[indices[:kept]] = softmax(values[:kept].astype(np.float64))
+    return result
+
+
+def draw(distribution):
+    cumulative = np.cumsum(distribution)
+    choice = np.searchsorted(cumulative, np.random.random_sample() * cumulative[-1])
+    return int(min(choice, len(distribution) - 1))
+
+
+class Row:
+    """One row's tokens, with the model's and the draft's keys and values."""
+
+    def __init__(self, model, draft, tokens, past, size, settings, cache=None):
+        self.model = model
+        self.draft = draft
+        self.tokens = list(tokens)
+        self.settings = settings
+        self.pads = np.zeros([1], dtype=np.int64)
+        self.past = model.past_buffer(1, size)
+        self.past[:, :, :, :, : past.shape[4]] = past
+        # How many of the tokens each model has keys and values for
+        self.run = past.shape[4]
+        self.draft_past = draft.past_buffer(1, size)
+        self.draft_run = 0
+        if cache and "draft_tokens" in cache:
+            # The draft always has at least one token left to run
+            cached = cache["draft_tokens"]
+            limit = min(len(cached), len(self.tokens) - 1)
+            while self.draft_run < limit and (
+                cached[self.draft_run] == self.tokens[self.draft_run]
+            ):
+                self.draft_run += 1
+            self.draft_past[:, :, :, :, : self.draft_run] = cache["draft_presents"][
+                :, :, :, :, : self.draft_run
+            ]
+        self.used = np.zeros([model.hparams.n_vocab], dtype=bool)
+        self.used[self.tokens] = True
+        # How many tokens were drafted, and how many of those were kept
+        self.drafted = 0
+        self.kept = 0
+
+    def distribution(self, logits, used):
+        settings = self.settings
+        logits = logits / settings["temperature"]
+        logits = np.where(used, logits * settings["repetition_penalty"], logits)
+        return probabilities(logits, settings["top_k"], settings["top_p"])
+
+    def step(self, lookahead, budget):
+        """Sample between 1 and min(lookahead + 1, budget) tokens."""
+        count = min(lookahead, budget - 1)
+        used = self.used.copy()
+        drafted = []
+        proposals = []
+        for _ in range(count):
+            sequence = (self.tokens + drafted)[self.draft_run :]
+            logits = self.draft.forward(
+                np.array([sequence]), self.draft_past, self.draft_run, self.pads
+            )[0]
+            self.draft_run += len(sequence)
+            q = self.distribution(logits, used)
+            token = draw(q)
+            drafted.append(token)
+            proposals.append(q)
+            used[token] = True
+
+        # One run of the model gives its distribution at every drafted token
+        # and after the last of them
+        sequence = (self.tokens + drafted)[self.run :]
+        logits = self.model.forward(
+            np.array([sequence]), self.past, self.run, self.pads, every_position=True
+        )[0][-(count + 1) :]
+        used = self.used.copy()
+        sampled = []
+        for token, q, values in zip(drafted, proposals, logits):
+            p = self.distribution(values, used)
+            if np.random.random_sample() * q[token] < p[token]:
+                sampled.append(token)
+                used[token] = True
+                continue
+            residual = np.maximum(p - q, 0)
+            sampled.append(draw(residual / residual.sum()))
+            break
+        else:
+            sampled.append(draw(self.distribution(logits[-1], used)))
+
+        kept = len(sampled) - 1
+        self.drafted += count
+        self.kept += kept
+        # Keys and values past the kept drafts are overwritten next step
+        self.run = len(self.tokens) + kept
+        self.draft_run = min(self.draft_run, len(self.tokens) + kept)
+        self.tokens.extend(sampled)
+        self.used[sampled] = True
+        return sampled
+
+    def ends_with(self, end, sequence):
+        return self.tokens[end - len(sequence) : end] == list(sequence)
+
+    def save_draft(self, cache):
+        cache["draft_tokens"] = self.tokens[: self.draft_run]
+        cache["draft_presents"] = self.draft_past[:, :, :, :, : self.draft_run].copy()
+
+
+def sample_sequence(
+    *,
+    model,
+    draft,
+    lookahead,
+    length,
+    context,
+    past,
+    history,
+    pads,
+    temperature,
+    top_k,
+    top_p,
+    penalty,
+    stop_tokens=(),
+    stop_sequences=(),
+    min_length=0,
+    caches=None,
+    callback=None
+):
+    """Same as numpy_sample.sample_sequence, with draft proposing up to
+    lookahead tokens for each run of model.
+
+    Rows are sampled one after another, since each keeps a different number
+    of drafts per step. callback is called as callback(row, token, done) for
+    each token. Unlike the batched version, a row stops sampling at its own
+    stop, and its output and keys and values are padded with zeros to the
+    longest row's. caches has each row's story cache or None, which the
+    draft's keys and values are read from and saved to. Also returns how
+    many tokens were drafted and how many of those were kept.
+    """
+    rows = context.shape[0]
+    if caches is None:
+        caches = [None] * rows
+    tokens = np.concatenate([history, context], axis=1)
+    start = tokens.shape[1]
+    size = start + int(length.max())
+    stop_tokens = set(stop_tokens)
+
+    samplers = []
+    lengths = np.zeros([rows], dtype=np.int32)
+    for row in range(rows):
+        pad = pads[row]
+        sampler = Row(
+            model,
+            draft,
+            tokens[row, pad:],
+            past[row : row + 1, :, :, :, pad:],
+            size - pad,
+            {
+                "temperature": temperature[row],
+                "top_k": top_k[row],
+                "top_p": top_p[row],
+                "repetition_penalty": penalty[row],
+            },
+            caches[row],
+        )
+        samplers.append(sampler)
+        done = False
+        while not done:
+            sampled = sampler.step(lookahead, length[row] - lengths[row])
+            end = len(sampler.tokens) - len(sampled)
+            for token in sampled:
+                end += 1
+                lengths[row] += 1
+                hit = token in stop_tokens or any(
+                    sampler.ends_with(end, sequence) for sequence in stop_sequences
+                )
+                done = (hit and lengths[row] > min_length) or (
+                    lengths[row] >= length[row]
+                )
+                if callback is not None:
+                    callback(row, token, done)
+                if done:
+                    break
+        if caches[row] is not None:
+            sampler.save_draft(caches[row])
+
+    width = max(len(sampler.tokens) + pads[row] for row, sampler in enumerate(samplers))
+    output = np.zeros([rows, width], dtype=np.int64)
+    presents = model.past_buffer(rows, width - 1)
+    for row, sampler in enumerate(samplers):
+        pad = pads[row]
+        end = pad + len(sampler.tokens)
+        output[row, pad:end] = sampler.tokens
+        # Every token but the last has been run through the model
+        presents[row, :, :, :, pad : end - 1] = sampler.past[
+            0, :, :, :, : len(sampler.tokens) - 1
+        ]
+    drafted = sum(sampler.drafted for sampler in samplers)
+    kept = sum(sampler.kept for sampler in samplers)
+    return output, presents, lengths, drafted, kept
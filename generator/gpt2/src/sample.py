@@ -2,19 +2,26 @@ import tensorflow as tf
 from generator.gpt2.src import model
 
 
-def penalize_used(logits, output):
+def used_tokens(output, n_vocab, pads=None):
+    """[batch, n_vocab] mask of the tokens each row of output contains,
+    not counting the first pads[row] tokens of padding."""
+    batch, length = model.shape_list(output)
+    rows = tf.tile(tf.range(batch)[:, tf.newaxis], [1, length])
+    indices = tf.stack([rows, output], axis=-1)
+    counted = tf.ones_like(output)
+    if pads is not None:
+        real = tf.range(length)[tf.newaxis, :] >= pads[:, tf.newaxis]
+        counted = tf.cast(real, output.dtype)
+    counts = tf.scatter_nd(indices, counted, [batch, n_vocab])
+    return counts > 0
 
-    # I want to change the indices of logits wherever the index is found in output
-    change_tensor = tf.zeros_like(logits, dtype=logits.dtype)
-    unique = tf.unique(output[0])[0]
-    ones = tf.ones_like(unique, dtype=unique.dtype)
-    indices = tf.expand_dims(unique, 1)
-
-    updates = tf.scatter_nd(indices, ones, [logits.shape[1]])
 
-    bool_tensor = tf.expand_dims(tf.cast(updates, tf.bool), 0)
+def penalize_used(logits, used, penalty):
 
-    return tf.compat.v1.where(bool_tensor, logits * 0.85, logits)
+    # I want to change the indices of logits wherever the index is found in output
+    # (penalty can be a single factor or one per row)
+    penalty = tf.reshape(tf.cast(penalty, logits.dtype), [-1, 1])
+    return tf.compat.v1.where(used, logits * penalty, logits)
 
 
 def top_k_logits(logits, k):
@@ -36,7 +43,7 @@ def top_k_logits(logits, k):
 
 def top_p_logits(logits, p):
     """Nucleus sampling"""
-    batch, _ = logits.shape.as_list()
+    batch = tf.shape(logits)[0]
     sorted_logits = tf.sort(logits, direction="DESCENDING", axis=-1)
     cumulative_probs = tf.cumsum(tf.nn.softmax(sorted_logits, axis=-1), axis=-1)
     indices = tf.stack(
@@ -49,10 +56,65 @@ def top_p_logits(logits, p):
         ],
         axis=-1,
     )
-    min_values = tf.gather_nd(sorted_logits, indices)
+    min_values = tf.gather_nd(sorted_logits, indices)[:, tf.newaxis]
     return tf.where(logits < min_values, tf.ones_like(logits) * -1e10, logits,)
 
 
+def sample_top_k_top_p(logits, k, p, seed=None):
+    """Sample one token per row from the top k logits after nucleus filtering.
+
+    Same distribution as sampling from top_p_logits(top_k_logits(logits, k), p),
+    but only the k survivors get sorted and softmaxed rather than the whole
+    vocabulary.
+
+    k and p can be single values or one per row. A k of 0 means no
+    truncation for that row. With a seed (a [2] tensor) the draw is stateless,
+    so the same logits and seed always sample the same tokens.
+    """
+    batch, n_vocab = model.shape_list(logits)
+    k = tf.broadcast_to(tf.reshape(k, [-1]), [batch])
+    k = tf.where(k > 0, k, tf.fill([batch], n_vocab))
+    # Only as many survivors as the widest row needs get sorted, and the
+    # narrower rows drop the ones past their own k
+    values, indices = tf.nn.top_k(logits, k=tf.reduce_max(k))
+    ranks = tf.range(tf.shape(values)[1])[tf.newaxis, :]
+    values = tf.where(
+        ranks < k[:, tf.newaxis], values, tf.ones_like(values) * -1e10
+    )
+    values = top_p_logits(values, p=tf.reshape(p, [-1, 1]))
+    if seed is None:
+        choices = tf.multinomial(values, num_samples=1, output_dtype=tf.int32)
+    else:
+        choices = tf.random.stateless_categorical(values, 1, seed, dtype=tf.int32)
+    rows = tf.range(batch)[:, tf.newaxis]
+    return tf.gather_nd(indices, tf.concat([rows, choices], axis=1))[:, tf.newaxis]
+
+
+def stopped(output, samples, stop_tokens, stop_sequences):
+    """Which rows just sampled a stop token or finished a stop sequence."""
+    batch, _ = model.shape_list(samples)
+    hit = tf.zeros([batch], dtype=tf.bool)
+    if stop_tokens:
+        hit = tf.reduce_any(
+            tf.equal(samples, tf.constant(stop_tokens, dtype=samples.dtype)[None, :]),
+            axis=-1,
+        )
+    for sequence in stop_sequences or []:
+        n = len(sequence)
+
+        def _ends_with(sequence=sequence, n=n):
+            tail = output[:, -n:]
+            return tf.reduce_all(
+                tf.equal(tail, tf.constant(sequence, dtype=output.dtype)[None, :]),
+                axis=-1,
+            )
+
+        hit = hit | tf.cond(
+            tf.shape(output)[1] >= n, _ends_with, lambda: tf.zeros([batch], tf.bool)
+        )
+    return hit
+
+
 def sample_sequence(
     *,
     hparams,
@@ -60,19 +122,71 @@ def sample_sequence(
     start_token=None,
     batch_size=None,
     context=None,
+    past=None,
+    history=None,
     temperature=1,
     top_k=0,
-    top_p=1
+    top_p=1,
+    penalty=0.85,
+    stop_tokens=None,
+    stop_sequences=None,
+    min_length=0,
+    callback=None,
+    callback_inputs=(),
+    preallocate=False,
+    pads=None,
+    seed=None
 ):
+    """Sample up to `length` tokens following `context`.
+
+    `past` holds keys and values the model already computed for the tokens in
+    `history`, so only `context` has to be run through the model before
+    sampling starts.
+
+    Rows can be left padded to the same length, with `pads` saying how many
+    tokens of padding (counted from the start of history) each one has.
+
+    `length`, `temperature`, `top_k`, `top_p` and `penalty` can each be one
+    value or a tensor with one per row, so rows with different settings can
+    share a run. Logits of tokens a row has already used (in history, context
+    or its samples) are multiplied by `penalty`.
+
+    A row stops once it samples one of `stop_tokens` or the last token of one
+    of `stop_sequences` (lists of token ids), as long as it has sampled more
+    than `min_length` tokens. Sampling ends when every row has stopped.
+
+    With `preallocate`, keys and values are kept in a buffer with room for
+    every position sampling will reach and each step is written into it,
+    rather than being concatenated onto a copy of everything before it.
+    Either way the same keys and values are returned.
+
+    If given, `callback` is called from inside the loop after every step
+    with the values of `callback_inputs`, that step's samples and which rows
+    have stopped, so tokens can be streamed out while sampling goes on.
+
+    With a `seed` (an int64 tensor of shape [2]), every step samples
+    statelessly from the seed and its position, so the same inputs and seed
+    give the same tokens in any session or copy of the graph.
+
+    Returns the tokens (history, context and samples), the keys and values
+    for all of them but the last sample, and how many tokens each row
+    sampled up to and including its stop. Every row samples as many tokens as
+    the longest `length`, but rows stop counting at their own.
+    """
     if start_token is None:
         assert context is not None, "Specify exactly one of start_token and context!"
     else:
         assert context is None, "Specify exactly one of start_token and context!"
         context = tf.fill([batch_size, 1], start_token)
 
-    def step(hparams, tokens, past=None):
+    def step(hparams, tokens, past=None, past_length=None):
         lm_output = model.model(
-            hparams=hparams, X=tokens, past=past, reuse=tf.AUTO_REUSE
+            hparams=hparams,
+            X=tokens,
+            past=past,
+            reuse=tf.AUTO_REUSE,
+            past_length=past_length,
+            pads=pads,
         )
 
         logits = lm_output["logits"][:, :, : hparams.n_vocab]
@@ -85,39 +199,102 @@ def sample_sequence(
 
     with tf.name_scope("sample_sequence"):
 
-        def body(past, prev, output):
-            next_outputs = step(hparams, prev, past=past)
-            logits = next_outputs["logits"][:, -1, :] / tf.to_float(temperature)
-            logits = penalize_used(logits, output)
-            logits = top_k_logits(logits, k=top_k)
-            logits = top_p_logits(logits, p=top_p)
-            samples = tf.multinomial(logits, num_samples=1, output_dtype=tf.int32)
+        def body(past, prev, output, used, done, lengths, buffered=preallocate):
+            if buffered:
+                # Everything in output before prev is already in the buffer
+                past_length = tf.shape(output)[1] - tf.shape(prev)[1]
+                next_outputs = step(hparams, prev, past=past, past_length=past_length)
+                # The buffer is written in place, so only after every layer
+                # has read it
+                with tf.control_dependencies([next_outputs["logits"]]):
+                    presents = model.write_past(
+                        past, next_outputs["presents"], past_length
+                    )
+            else:
+                next_outputs = step(hparams, prev, past=past)
+                presents = (
+                    next_outputs["presents"]
+                    if past is None
+                    else tf.concat([past, next_outputs["presents"]], axis=-2)
+                )
+            logits = next_outputs["logits"][:, -1, :] / temperature
+            logits = penalize_used(logits, used, penalty)
+            step_seed = None
+            if seed is not None:
+                step_seed = seed + tf.stack([0, tf.cast(tf.shape(output)[1], tf.int64)])
+            samples = sample_top_k_top_p(logits, k=top_k, p=top_p, seed=step_seed)
+            output = tf.concat([output, samples], axis=1)
+            used = used | tf.equal(tf.range(hparams.n_vocab)[tf.newaxis, :], samples)
+            # The batch runs in lockstep, so rows that have stopped keep
+            # sampling but stop counting
+            lengths = lengths + tf.cast(tf.logical_not(done), tf.int32)
+            hit = stopped(output, samples, stop_tokens, stop_sequences)
+            done = done | (hit & (lengths > min_length)) | (lengths >= length)
+            if callback is not None:
+                called = tf.py_func(
+                    callback,
+                    list(callback_inputs) + [samples, done],
+                    tf.bool,
+                    stateful=True,
+                )
+                # The next step waits on the callback so it sees every token
+                with tf.control_dependencies([called]):
+                    samples = tf.identity(samples)
             return [
-                next_outputs["presents"]
-                if past is None
-                else tf.concat([past, next_outputs["presents"]], axis=-2),
+                presents,
                 samples,
-                tf.concat([output, samples], axis=1),
+                output,
+                used,
+                done,
+                lengths,
             ]
 
-        past, prev, output = body(None, context, context)
+        if history is None:
+            output = context
+        else:
+            output = tf.concat([history, context], axis=1)
+        batch = tf.shape(context)[0]
+        length = tf.broadcast_to(tf.reshape(length, [-1]), [batch])
+        temperature = tf.reshape(tf.cast(temperature, tf.float32), [-1, 1])
+        top_k = tf.cast(top_k, tf.int32)
+        top_p = tf.cast(top_p, tf.float32)
+        done = tf.zeros([batch], dtype=tf.bool)
+        lengths = tf.zeros([batch], dtype=tf.int32)
+        used = used_tokens(output, hparams.n_vocab, pads)
+        # The context is run the usual way, attending only to what's there
+        loop_vars = body(past, context, output, used, done, lengths, buffered=False)
+        past_invariant = model.past_shape(hparams=hparams, batch_size=batch_size)
+        if preallocate:
+            # Pad what's been computed so far out to the whole buffer, which
+            # never has to hold the last sample
+            past = model.to_buffer(loop_vars[0])
+            padding = tf.reduce_max(length) - 1
+            past = tf.pad(past, [[0, 0], [0, 0], [0, 0], [0, 0], [0, padding], [0, 0]])
+            loop_vars[0] = past
+            past_invariant = model.buffer_shape(hparams=hparams, batch_size=batch_size)
 
-        def cond(*args):
-            return True
+        def cond(past, prev, output, used, done, lengths):
+            return tf.logical_not(tf.reduce_all(done))
 
-        _, _, tokens = tf.while_loop(
+        past, _, tokens, _, _, lengths = tf.while_loop(
             cond=cond,
             body=body,
-            maximum_iterations=length - 1,
-            loop_vars=[past, prev, output],
+            maximum_iterations=tf.reduce_max(length) - 1,
+            loop_vars=loop_vars,
             shape_invariants=[
-                tf.TensorShape(
-                    model.past_shape(hparams=hparams, batch_size=batch_size)
-                ),
-                tf.TensorShape([batch_size, None]),
+                tf.TensorShape(past_invariant),
+                # One token at a time, which lets the model take its
+                # decoding path
+                tf.TensorShape([batch_size, 1]),
                 tf.TensorShape([batch_size, None]),
+                tf.TensorShape([batch_size, hparams.n_vocab]),
+                tf.TensorShape([batch_size]),
+                tf.TensorShape([batch_size]),
             ],
             back_prop=False,
         )
 
-        return tokens
+        if preallocate:
+            # The last sample was never run through the model
+            past = model.from_buffer(past[:, :, :, :, : tf.shape(tokens)[1] - 1])
+        return tokens, past, lengths
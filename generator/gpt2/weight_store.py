@@ -0,0 +1,58 @@
+"""Model weights in one flat file that's memory-mapped instead of read.
+
+weights.bin holds every array back to back, each starting on a page
+boundary, and weights.json says where each one is along with its dtype and
+shape. Opening a store maps the file read-only and returns views into it, so
+nothing is read from disk until it's used, and every process that opens the
+same store shares one copy of it in the page cache.
+"""
+import json
+import mmap
+import os
+
+import numpy as np
+
+# Page aligned arrays can be handed to TensorFlow without a copy, and never
+# share a page with the end of the array before them
+ALIGNMENT = mmap.PAGESIZE
+
+
+def exists(directory):
+    return os.path.exists(os.path.join(directory, "weights.json"))
+
+
+def save(directory, arrays):
+    """Write arrays (a dict of name to array) to directory's weight store."""
+    index = {}
+    offset = 0
+    with open(os.path.join(directory, "weights.bin"), "wb") as f:
+        for name in sorted(arrays):
+            value = np.ascontiguousarray(arrays[name])
+            offset += -offset % ALIGNMENT
+            f.seek(offset)
+            f.write(value.tobytes())
+            index[name] = {
+                "dtype": value.dtype.str,
+                "shape": list(value.shape),
+                "offset": offset,
+            }
+            offset += value.nbytes
+    with open(os.path.join(directory, "weights.json"), "w") as f:
+        json.dump(index, f)
+
+
+def load(directory):
+    """A dict of name to a read-only view of that array in the mapped file."""
+    with open(os.path.join(directory, "weights.json")) as f:
+        index = json.load(f)
+    # Plain arrays rather than np.memmap, whose results are memmaps too
+    data = np.memmap(os.path.join(directory, "weights.bin"), mode="r")
+    data = data.view(np.ndarray)
+    arrays = {}
+    for name, entry in index.items():
+        dtype = np.dtype(entry["dtype"])
+        count = int(np.prod(entry["shape"]))
+        start = entry["offset"]
+        view = data[start : start + count * dtype.itemsize].view(dtype)
+        arrays[name] = view.reshape(entry["shape"])
+    return arrays
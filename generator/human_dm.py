@@ -2,5 +2,5 @@ from story.utils import *
 
 
 class HumanDM:
-    def generate(self, prompt, options=None, seed=None):
+    def generate(self, prompt, options=None, seed=None, cache=None, stream=None):
         return input()
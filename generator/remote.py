@@ -0,0 +1,103 @@
+"""A client for generator.server that stands in for a generator."""
+import collections
+import json
+import urllib.error
+import urllib.request
+import uuid
+
+from generator.gpt2.generator_base import GeneratorBase
+from generator.stand_in import StandIn
+
+
+class RemoteGenerationError(Exception):
+    """The generation server couldn't generate a result."""
+
+
+class ServerUnreachable(ConnectionError):
+    """A request couldn't be sent to the generation server.
+
+    Unlike other errors (like timing out waiting for the result), the server
+    never got the request, so it can be sent to another one.
+    """
+
+
+class RemoteGenerator(StandIn):
+    """Sends generate calls to a generation server at url.
+
+    It can be given to a story manager in place of a generator, and the
+    model is only loaded by the server (see StandIn). Each story's
+    cache stays in the server, under a key kept in the story's own cache.
+    Requests fail if the server goes timeout seconds without sending
+    anything, or wait as long as it takes with timeout None.
+    """
+
+    wrapped = "local"
+
+    def __init__(self, url, timeout=None):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        info = self._get("/info")
+        self.local = GeneratorBase(
+            model_name=info["model_name"], generate_num=info["generate_num"]
+        )
+        self.censor = info["censor"]
+
+    def _get(self, path):
+        with urllib.request.urlopen(self.url + path, timeout=self.timeout) as f:
+            return json.load(f)
+
+    def _post(self, request, stream=None, path="/generate"):
+        http_request = urllib.request.Request(
+            self.url + path,
+            data=json.dumps(request).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        try:
+            response = urllib.request.urlopen(http_request, timeout=self.timeout)
+        except urllib.error.HTTPError:
+            raise
+        except urllib.error.URLError as e:
+            raise ServerUnreachable("%s: %s" % (self.url, e.reason))
+        with response as f:
+            # Streamed answers are a JSON object per line, the others just one
+            for line in f:
+                message = json.loads(line)
+                if "stream" in message:
+                    stream(message["stream"])
+                elif "error" in message:
+                    raise RemoteGenerationError(message["error"])
+                else:
+                    return message["result"]
+        raise RemoteGenerationError("The server closed the connection")
+
+    def _options(self, options):
+        # The server's generator has its own censor, so always say which
+        options = dict(options or {})
+        options.setdefault("censor", self.censor)
+        return options
+
+    def generate_tokens(self, context_tokens, options=None, cache=None, stream=None):
+        request = {
+            "tokens": [int(token) for token in context_tokens],
+            "options": self._options(options),
+            "stream": stream is not None,
+        }
+        if cache is not None:
+            if "server_cache_key" not in cache:
+                cache["server_cache_key"] = uuid.uuid4().hex
+            request["cache"] = cache["server_cache_key"]
+        return self._post(request, stream)
+
+    def forget_cache(self, cache):
+        if "server_cache_key" in cache:
+            self._post({"cache": cache["server_cache_key"]}, path="/forget")
+        cache.clear()
+
+    def generate_raw(self, prompt, options=None):
+        return self._post({"prompt": prompt, "options": options, "raw": True})
+
+    @property
+    def batch_sizes(self):
+        """Batch size -> number of batches the server ran with that size."""
+        sizes = self._get("/stats")["batch_sizes"]
+        return collections.Counter({int(size): n for size, n in sizes.items()})
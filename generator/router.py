@@ -0,0 +1,254 @@
+import bisect
+import collections
+import hashlib
+import threading
+import time
+import uuid
+
+from generator.remote import RemoteGenerator, ServerUnreachable
+from generator.stand_in import StandIn
+
+
+def ring_hash(value):
+    return int.from_bytes(hashlib.md5(str(value).encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hashing of keys to nodes.
+
+    Each node is put on the ring at `replicas` points, and a key belongs to
+    the first node point at or after its own hash. Adding or removing a node
+    only moves the keys between its points and the ones before them, about
+    1 / len(nodes) of all keys, and the virtual points spread those evenly
+    over the other nodes.
+    """
+
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        self.nodes = set()
+        self._hashes = []
+        self._owners = []
+        for node in nodes:
+            self.add(node)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def add(self, node):
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for i in range(self.replicas):
+            point = ring_hash("%s#%d" % (node, i))
+            index = bisect.bisect(self._hashes, point)
+            self._hashes.insert(index, point)
+            self._owners.insert(index, node)
+
+    def remove(self, node):
+        if node not in self.nodes:
+            return
+        self.nodes.remove(node)
+        kept = [
+            (point, owner)
+            for point, owner in zip(self._hashes, self._owners)
+            if owner != node
+        ]
+        self._hashes = [point for point, _ in kept]
+        self._owners = [owner for _, owner in kept]
+
+    def node_for(self, key):
+        if not self._hashes:
+            raise LookupError("There are no nodes to put %r on" % (key,))
+        index = bisect.bisect_left(self._hashes, ring_hash(key))
+        return self._owners[index % len(self._owners)]
+
+
+class GenerationRouter(StandIn):
+    """Sends each story to one of several generation servers.
+
+    A story's cache lives in the server that generated its last turn, so
+    every story is kept on one server by hashing its key (the bot uses the
+    game's channel id) onto a HashRing of server URLs. Servers can be added
+    and removed while it runs, and only the stories that hashed to the
+    changed server move. A server that can't be reached, when the router
+    starts or later, is taken off the ring and the request is tried on the
+    next one. It's checked again after retry_delay seconds, then twice as
+    long after each failed check up to max_retry_delay, and goes back on the
+    ring once it answers, taking back the stories that hashed to it. A
+    server that's reached but doesn't answer within timeout seconds stays on
+    the ring, and only that request fails.
+
+    It stands in for a generator like RemoteGenerator does, but stories
+    should be given route(key) so they have a key before their first turn.
+    Stories without one are routed by a key kept in their cache.
+    """
+
+    # The first server's, see RemoteGenerator
+    wrapped = "local"
+
+    def __init__(
+        self, urls, replicas=100, timeout=None, retry_delay=1, max_retry_delay=60
+    ):
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.ring = HashRing(replicas=replicas)
+        self.nodes = {}
+        # url -> (when to check it next, seconds to wait after that) for the
+        # servers that couldn't be reached
+        self.down = {}
+        self._lock = threading.Lock()
+
+        # Turns sent to the server that had the story's cache, turns sent
+        # to another one, and stories' first turns
+        self.hits = 0
+        self.misses = 0
+        self.first_turns = 0
+        self.removed = 0
+        self.rejoined = 0
+        self.requests = collections.Counter()
+
+        error = None
+        for url in urls:
+            try:
+                self.add_node(url)
+            except OSError as e:
+                print("Generation server %s is down: %s" % (url, e))
+                self._mark_down(url)
+                error = e
+        if not self.nodes:
+            raise error or ValueError("No generation servers were given")
+        self.local = next(iter(self.nodes.values())).local
+        self.censor = self.local.censor
+
+    def add_node(self, url):
+        node = RemoteGenerator(url, self.timeout)
+        with self._lock:
+            self.down.pop(node.url, None)
+            self.nodes[node.url] = node
+            self.ring.add(node.url)
+
+    def remove_node(self, url):
+        with self._lock:
+            url = url.rstrip("/")
+            self.down.pop(url, None)
+            self.ring.remove(url)
+            self.nodes.pop(url, None)
+
+    def _mark_down(self, url):
+        url = url.rstrip("/")
+        with self._lock:
+            self.ring.remove(url)
+            self.nodes.pop(url, None)
+            if url in self.down:
+                delay = min(self.down[url][1] * 2, self.max_retry_delay)
+            else:
+                delay = self.retry_delay
+            self.down[url] = (time.monotonic() + delay, delay)
+
+    def check_down(self):
+        """Put the servers that are down and due a check back if they answer."""
+        now = time.monotonic()
+        with self._lock:
+            due = [url for url, (when, _) in self.down.items() if when <= now]
+            for url in due:
+                # So only this thread checks it
+                self.down[url] = (float("inf"), self.down[url][1])
+        for url in due:
+            try:
+                self.add_node(url)
+            except OSError:
+                self._mark_down(url)
+            else:
+                print("Generation server %s is back" % url)
+                self.rejoined += 1
+
+    def route(self, key):
+        """A generator for the stories with this key."""
+        return Route(self, key)
+
+    def _place(self, key, cache):
+        with self._lock:
+            url = self.ring.node_for(key)
+            node = self.nodes[url]
+            self.requests[url] += 1
+            if cache is None:
+                return node
+            placed = cache.get("node")
+            if placed is None:
+                self.first_turns += 1
+            elif placed == url:
+                self.hits += 1
+            else:
+                self.misses += 1
+            cache["node"] = url
+            return node
+
+    def generate_tokens(
+        self, context_tokens, options=None, cache=None, stream=None, key=None
+    ):
+        if key is None:
+            key = uuid.uuid4().hex if cache is None else cache.get("route_key")
+        if key is None:
+            key = cache["route_key"] = uuid.uuid4().hex
+        options = dict(options or {})
+        options.setdefault("censor", self.censor)
+        self.check_down()
+        while True:
+            node = self._place(key, cache)
+            try:
+                return node.generate_tokens(context_tokens, options, cache, stream)
+            except ServerUnreachable as e:
+                # Only then is it safe to send the request to another server
+                print("Generation server %s is down: %s" % (node.url, e))
+                self.removed += 1
+                self._mark_down(node.url)
+                if not self.ring:
+                    raise
+
+    def forget_cache(self, cache):
+        with self._lock:
+            node = self.nodes.get(cache.get("node"))
+        if node is not None:
+            try:
+                node.forget_cache(cache)
+            except OSError as e:
+                print("Couldn't free a cache in %s: %s" % (node.url, e))
+        cache.clear()
+
+    def generate_raw(self, prompt, options=None):
+        self.check_down()
+        return self._place(uuid.uuid4().hex, None).generate_raw(prompt, options)
+
+    def hit_rate(self):
+        """Fraction of stories' later turns sent to the server with their cache."""
+        return self.hits / max(self.hits + self.misses, 1)
+
+    @property
+    def batch_sizes(self):
+        """Batch size -> number of batches run with that size, in every server.
+
+        Servers that can't be reached are left out.
+        """
+        total = collections.Counter()
+        for node in list(self.nodes.values()):
+            try:
+                total.update(node.batch_sizes)
+            except OSError as e:
+                print("Couldn't get batch sizes from %s: %s" % (node.url, e))
+        return total
+
+
+class Route(StandIn):
+    """A GenerationRouter's generator for the stories with one key."""
+
+    wrapped = "router"
+
+    def __init__(self, router, key):
+        self.router = router
+        self.key = key
+
+    def generate_tokens(self, context_tokens, options=None, cache=None, stream=None):
+        return self.router.generate_tokens(
+            context_tokens, options, cache, stream, self.key
+        )
@@ -0,0 +1,204 @@
+"""Serve a generator over HTTP, so it stays loaded while its front ends restart.
+
+The bot, play.py and play_dm.py use it through generator.remote's
+RemoteGenerator in place of a generator of their own. Several front ends can
+share one server, and requests from all of them are batched together. Run
+from the top of the repository:
+
+    python -m generator.server --model-name model_v5 --port 8787
+
+POST /generate takes a JSON object with the prompt, as "prompt" or as
+already encoded "tokens", and optionally "options" (what
+generate_tokens_batch takes), "cache" (a key for the story being continued)
+and "stream". It answers with {"result": text}, or {"error": message} if
+generating failed. With "stream", the answer is one JSON object per line:
+{"stream": text} whenever more of the result has been sampled, then the
+result or error. With "raw", the prompt is continued as it is, like
+generate_raw, with no cache and no clean up. POST /forget takes {"cache":
+key} and frees that story's cache, once the story is over.
+
+GET /info describes the generator, so clients can encode and clean up text
+the same way, and GET /stats reports how requests were batched.
+"""
+import argparse
+import json
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from generator.batching import BatchScheduler
+from generator.caches import DEFAULT_MAX_BYTES, CacheStore
+
+
+class GenerationServer(socketserver.ThreadingMixIn, HTTPServer):
+    """Runs each request in its own thread, batched by scheduler."""
+
+    daemon_threads = True
+
+    def __init__(self, address, scheduler, max_cache_bytes=DEFAULT_MAX_BYTES):
+        super().__init__(address, GenerationHandler)
+        self.scheduler = scheduler
+        self.caches = CacheStore(max_cache_bytes)
+
+    def info(self):
+        scheduler = self.scheduler
+        return {
+            "model_name": scheduler.model_name,
+            "generate_num": scheduler.generate_num,
+            "censor": scheduler.censor,
+        }
+
+    def stats(self):
+        return {
+            "batch_sizes": dict(self.scheduler.batch_sizes),
+            "caches": len(self.caches),
+            "cache_bytes": self.caches.nbytes(),
+        }
+
+    def generate(self, request, stream=None):
+        scheduler = self.scheduler
+        options = request.get("options")
+        if "tokens" in request:
+            context_tokens = request["tokens"]
+        elif request.get("raw"):
+            context_tokens = scheduler.encode(request["prompt"])
+        else:
+            context_tokens = scheduler.encode(
+                scheduler.prompt_replace(request["prompt"])
+            )
+        if request.get("raw"):
+            return scheduler.sample_batch([context_tokens], options=options)[0]
+        try:
+            return scheduler.generate_tokens(
+                context_tokens, options, self.caches.get(request.get("cache")), stream
+            )
+        finally:
+            self.caches.trim()
+
+
+class GenerationHandler(BaseHTTPRequestHandler):
+    def send_json(self, message, status=200):
+        body = json.dumps(message).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/info":
+            self.send_json(self.server.info())
+        elif self.path == "/stats":
+            self.send_json(self.server.stats())
+        else:
+            self.send_json({"error": "Not found: %s" % self.path}, 404)
+
+    def do_POST(self):
+        if self.path not in ("/generate", "/forget"):
+            self.send_json({"error": "Not found: %s" % self.path}, 404)
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length).decode("utf-8"))
+        except ValueError as e:
+            self.send_json({"error": "Bad request: %s" % e}, 400)
+            return
+
+        if self.path == "/forget":
+            self.server.caches.forget(request.get("cache"))
+            self.send_json({"result": None})
+            return
+
+        if not request.get("stream") or request.get("raw"):
+            try:
+                message = {"result": self.server.generate(request)}
+            except Exception as e:
+                message = {"error": "%s: %s" % (type(e).__name__, e)}
+            self.send_json(message)
+            return
+
+        # The answer's length isn't known yet, so it ends when the
+        # connection is closed
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        write_lock = threading.Lock()
+
+        def write(message):
+            with write_lock:
+                try:
+                    self.wfile.write(json.dumps(message).encode("utf-8") + b"\n")
+                    self.wfile.flush()
+                except OSError:
+                    # The client went away, but the result still goes in the
+                    # story's cache for when it comes back
+                    pass
+
+        try:
+            result = self.server.generate(request, lambda text: write({"stream": text}))
+        except Exception as e:
+            write({"error": "%s: %s" % (type(e).__name__, e)})
+            return
+        write({"result": result})
+
+    def log_message(self, format, *args):
+        # One line per action would drown out everything else
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8787)
+    parser.add_argument("--model-name", default="model_v5")
+    parser.add_argument("--share-weights", action="store_true")
+    parser.add_argument(
+        "--draft-model-name",
+        help="generate in NumPy with this model drafting tokens for speculative "
+        "decoding",
+    )
+    parser.add_argument("--lookahead", type=int, default=4)
+    parser.add_argument("--window", type=float, default=0.05)
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument(
+        "--max-cache-mb",
+        type=int,
+        default=DEFAULT_MAX_BYTES // 2 ** 20,
+        help="memory for stories' caches, about 0.6 MB a token with model_v5",
+    )
+    args = parser.parse_args()
+
+    if args.draft_model_name:
+        from generator.gpt2.numpy_generator import NumpyGPT2Generator
+
+        generator = NumpyGPT2Generator(
+            model_name=args.model_name,
+            draft_model_name=args.draft_model_name,
+            lookahead=args.lookahead,
+            max_cache_bytes=None,
+        )
+    else:
+        from generator.gpt2.gpt2_generator import GPT2Generator
+
+        generator = GPT2Generator(
+            model_name=args.model_name,
+            share_weights=args.share_weights,
+            max_cache_bytes=None,
+        )
+    scheduler = BatchScheduler(
+        generator, window=args.window, max_batch_size=args.max_batch_size
+    )
+    server = GenerationServer(
+        (args.host, args.port), scheduler, args.max_cache_mb * 2 ** 20
+    )
+    print("Serving %s on http://%s:%d" % (args.model_name, args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+class StandIn:
+    """Base for what a story manager can use in place of a generator.
+
+    Subclasses pass generate_tokens on (to a batch, a worker, a server...),
+    and the attributes in `forwarded` (token counting, censor, context
+    budget...) are the generator's in the attribute named by `wrapped`.
+    When the model runs somewhere else (WorkerPool, RemoteGenerator), that's
+    a GeneratorBase with no model in `local`, so tokenizing and cleaning up
+    text still happen in this process. It can't generate, so nothing else
+    is forwarded. They
+    report batch_sizes, batch size -> number of batches run with that size.
+    """
+
+    wrapped = "generator"
+    forwarded = frozenset(
+        [
+            "censor",
+            "clean_result",
+            "context_budget",
+            "defaults",
+            "enc",
+            "encode",
+            "fallback_result",
+            "generate_num",
+            "hparams",
+            "model_name",
+            "prompt_replace",
+            "prompt_tokens_replace",
+            "result_replace",
+        ]
+    )
+
+    def __getattr__(self, name):
+        if name not in self.forwarded:
+            raise AttributeError(
+                "%r object has no attribute %r" % (type(self).__name__, name)
+            )
+        return getattr(getattr(self, self.wrapped), name)
+
+    def generate(self, prompt, options=None, seed=1, cache=None, stream=None):
+        context_tokens = self.encode(self.prompt_replace(prompt))
+        return self.generate_tokens(context_tokens, options, cache, stream)
+
+    def generate_tokens(self, context_tokens, options=None, cache=None, stream=None):
+        raise NotImplementedError()
+
+    def forget_cache(self, cache):
+        """Free a story's cache, wherever it's kept, once the story is over."""
+        getattr(self, self.wrapped).forget_cache(cache)
+
+    def batch_size_distribution(self):
+        """Fraction of batches run at each batch size."""
+        sizes = self.batch_sizes
+        total = sum(sizes.values())
+        return {size: count / total for size, count in sorted(sizes.items())}
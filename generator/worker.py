@@ -0,0 +1,83 @@
+"""What each of a WorkerPool's processes runs.
+
+Nothing heavy is imported at the top of this module, so the generator is
+only loaded once the process is pinned to its cores.
+"""
+import os
+import threading
+
+
+def run(
+    connection, cores, inter_op_threads, generator_kwargs, batching, max_cache_bytes
+):
+    """Serve requests from connection until the pool closes it.
+
+    Messages in are ("generate", request_id, cache_key, context_tokens,
+    options, streaming) and ("forget", cache_key). Messages out are ("ready", None, None) once the
+    generator is loaded, ("stream", request_id, text), ("result",
+    request_id, text), ("error", request_id, message) and ("batch_sizes",
+    None, counts).
+    """
+    if cores:
+        os.sched_setaffinity(0, cores)
+    from generator.batching import BatchScheduler
+    from generator.caches import CacheStore
+
+    generator_kwargs = dict(generator_kwargs, max_cache_bytes=None)
+    if generator_kwargs.get("draft_model_name"):
+        # Speculative decoding runs in NumPy, whose threads the pool limited
+        # before starting this process. It reads the weight store if there is
+        # one, shared or not.
+        from generator.gpt2.numpy_generator import NumpyGPT2Generator
+
+        generator_kwargs.pop("share_weights", None)
+        generator = NumpyGPT2Generator(**generator_kwargs)
+    else:
+        from generator.gpt2.gpt2_generator import GPT2Generator
+
+        generator_kwargs.pop("draft_model_name", None)
+        generator_kwargs.pop("lookahead", None)
+        generator = GPT2Generator(
+            intra_op_threads=len(cores),
+            inter_op_threads=inter_op_threads,
+            **generator_kwargs
+        )
+    scheduler = BatchScheduler(generator, **batching)
+
+    caches = CacheStore(max_cache_bytes)
+    send_lock = threading.Lock()
+
+    def send(*message):
+        with send_lock:
+            connection.send(message)
+
+    def serve(request_id, cache_key, context_tokens, options, streaming):
+        stream = None
+        if streaming:
+
+            def stream(text):
+                send("stream", request_id, text)
+
+        try:
+            result = scheduler.generate_tokens(
+                context_tokens, options, caches.get(cache_key), stream
+            )
+        except Exception as e:
+            # The exception itself might not survive pickling
+            send("error", request_id, "%s: %s" % (type(e).__name__, e))
+            return
+        finally:
+            caches.trim()
+        send("result", request_id, result)
+        send("batch_sizes", None, dict(scheduler.batch_sizes))
+
+    send("ready", None, None)
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            return
+        if message[0] == "generate":
+            threading.Thread(target=serve, args=message[1:], daemon=True).start()
+        elif message[0] == "forget":
+            caches.forget(message[1])
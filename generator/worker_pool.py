@@ -0,0 +1,267 @@
+import collections
+import inspect
+import itertools
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future
+
+from generator import worker
+from generator.caches import DEFAULT_MAX_BYTES
+from generator.gpt2.generator_base import GeneratorBase, call_stream
+from generator.stand_in import StandIn
+
+# Environment variables that size numpy's and OpenMP's thread pools, which
+# are set when a library loads, so workers have to be started with them
+THREAD_VARIABLES = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"]
+_environ_lock = threading.Lock()
+
+
+class WorkerError(Exception):
+    """A request raised an exception in its worker."""
+
+
+class WorkerCrashed(Exception):
+    """The worker running a request died before it finished."""
+
+
+class Worker:
+    """A worker process and the requests waiting on it."""
+
+    def __init__(self, index, cores):
+        self.index = index
+        self.cores = cores
+        self.process = None
+        self.connection = None
+        # Goes up each time the process is started, so caches placed in an
+        # earlier one aren't expected in it
+        self.generation = 0
+        # Whether it has loaded the model, and whether it never could
+        self.ready = False
+        self.failed = False
+        # request id -> (future, stream)
+        self.pending = {}
+        # How many stories' caches were placed in this process
+        self.caches = 0
+        self.batch_sizes = collections.Counter()
+        self.lock = threading.Lock()
+
+
+class WorkerPool(StandIn):
+    """Runs generation in worker processes and stands in for a generator.
+
+    Each list in core_groups is the cores of one worker, which pins itself
+    to them and sizes its TensorFlow and numpy thread pools to match, so
+    workers don't compete for cores or for one interpreter's GIL. Requests
+    are sent to workers over pipes, and every worker batches its own with a
+    BatchScheduler (window and max_batch_size). A story's cache lives in the
+    worker that first served it, so its turns keep going there, and each
+    worker keeps up to max_cache_bytes of them.
+
+    A worker that dies is started again, and the requests it had fail with
+    WorkerCrashed. One that dies before it has loaded the model is left
+    stopped. The remaining kwargs are GPT2Generator's, or with a
+    draft_model_name NumpyGPT2Generator's, and the ones GeneratorBase takes
+    are also used for the one without a model in `local` (see StandIn).
+    """
+
+    wrapped = "local"
+
+    def __init__(
+        self,
+        core_groups,
+        inter_op_threads=1,
+        window=0.05,
+        max_batch_size=8,
+        max_cache_bytes=DEFAULT_MAX_BYTES,
+        **generator_kwargs
+    ):
+        base_parameters = inspect.signature(GeneratorBase).parameters
+        self.local = GeneratorBase(
+            **{
+                name: value
+                for name, value in generator_kwargs.items()
+                if name in base_parameters
+            }
+        )
+        self.inter_op_threads = inter_op_threads
+        self.generator_kwargs = generator_kwargs
+        self.batching = {"window": window, "max_batch_size": max_batch_size}
+        self.max_cache_bytes = max_cache_bytes
+        self.restarts = 0
+        self.closed = False
+
+        self._context = multiprocessing.get_context("spawn")
+        self._lock = threading.Lock()
+        self._request_ids = itertools.count()
+        self._cache_keys = itertools.count()
+        self.workers = [Worker(i, list(cores)) for i, cores in enumerate(core_groups)]
+        for w in self.workers:
+            with w.lock:
+                self._start(w)
+
+    def _start(self, w):
+        # Called with w.lock held
+        connection, child = self._context.Pipe()
+        with _environ_lock:
+            saved = {name: os.environ.get(name) for name in THREAD_VARIABLES}
+            for name in THREAD_VARIABLES:
+                os.environ[name] = str(len(w.cores))
+            try:
+                w.process = self._context.Process(
+                    target=worker.run,
+                    args=(
+                        child,
+                        w.cores,
+                        self.inter_op_threads,
+                        self.generator_kwargs,
+                        self.batching,
+                        self.max_cache_bytes,
+                    ),
+                    daemon=True,
+                )
+                w.process.start()
+                # Before it's done starting up, so every thread it makes is
+                # pinned too
+                if w.cores:
+                    os.sched_setaffinity(w.process.pid, w.cores)
+            finally:
+                for name, value in saved.items():
+                    if value is None:
+                        os.environ.pop(name, None)
+                    else:
+                        os.environ[name] = value
+        child.close()
+        w.connection = connection
+        w.generation += 1
+        w.ready = False
+        w.caches = 0
+        threading.Thread(
+            target=self._read, args=(w, connection, w.generation), daemon=True
+        ).start()
+
+    def _read(self, w, connection, generation):
+        while True:
+            try:
+                kind, request_id, value = connection.recv()
+            except (EOFError, OSError):
+                break
+            if kind == "ready":
+                w.ready = True
+                continue
+            if kind == "batch_sizes":
+                w.batch_sizes = collections.Counter(value)
+                continue
+            with w.lock:
+                if kind == "stream":
+                    future, stream = w.pending[request_id]
+                else:
+                    future, stream = w.pending.pop(request_id)
+            if kind == "stream":
+                if stream is not None and not call_stream(stream, value):
+                    with w.lock:
+                        if request_id in w.pending:
+                            w.pending[request_id] = (future, None)
+            elif kind == "result":
+                future.set_result(value)
+            else:
+                future.set_exception(WorkerError(value))
+        self._restart(w, generation)
+
+    def _restart(self, w, generation):
+        with w.lock:
+            if self.closed or w.generation != generation:
+                return
+            failed = list(w.pending.values())
+            w.pending.clear()
+            w.process.join()
+            if w.ready:
+                print(
+                    "Generation worker %d exited with code %s, restarting it"
+                    % (w.index, w.process.exitcode)
+                )
+                self.restarts += 1
+                self._start(w)
+            else:
+                print(
+                    "Generation worker %d exited with code %s while loading"
+                    % (w.index, w.process.exitcode)
+                )
+                w.failed = True
+        for future, _ in failed:
+            future.set_exception(WorkerCrashed("Generation worker %d died" % w.index))
+
+    def _place(self, cache):
+        """The worker for a request, and its cache's key there."""
+        with self._lock:
+            running = [w for w in self.workers if not w.failed]
+            if not running:
+                raise WorkerCrashed("No generation worker could load the model")
+            least_busy = min(running, key=lambda w: (len(w.pending), w.caches))
+            if cache is None:
+                return least_busy, None
+            if "worker_cache_key" not in cache:
+                cache["worker_cache_key"] = next(self._cache_keys)
+            placed = cache.get("worker")
+            if placed is not None:
+                index, generation = placed
+                w = self.workers[index]
+                # A worker that failed while loading keeps its generation,
+                # but its stories have to move
+                if w.generation == generation and not w.failed:
+                    return w, cache["worker_cache_key"]
+            w = least_busy
+            w.caches += 1
+            cache["worker"] = (w.index, w.generation)
+            return w, cache["worker_cache_key"]
+
+    def generate_tokens(self, context_tokens, options=None, cache=None, stream=None):
+        w, cache_key = self._place(cache)
+        future = Future()
+        request_id = next(self._request_ids)
+        with w.lock:
+            w.pending[request_id] = (future, stream)
+            message = (
+                "generate",
+                request_id,
+                cache_key,
+                list(context_tokens),
+                options,
+                stream is not None,
+            )
+            try:
+                w.connection.send(message)
+            except (OSError, ValueError):
+                del w.pending[request_id]
+                raise WorkerCrashed("Generation worker %d died" % w.index)
+        return future.result()
+
+    def forget_cache(self, cache):
+        placed = cache.get("worker")
+        if placed is not None:
+            index, generation = placed
+            w = self.workers[index]
+            with w.lock:
+                if w.generation == generation and not w.failed:
+                    w.caches -= 1
+                    try:
+                        w.connection.send(("forget", cache["worker_cache_key"]))
+                    except (OSError, ValueError):
+                        # It died, and its caches with it
+                        pass
+        cache.clear()
+
+    @property
+    def batch_sizes(self):
+        """Batch size -> number of batches run with that size, in every worker."""
+        total = collections.Counter()
+        for w in self.workers:
+            total.update(w.batch_sizes)
+        return total
+
+    def close(self):
+        self.closed = True
+        for w in self.workers:
+            with w.lock:
+                w.connection.close()
+                w.process.terminate()
@@ -4,7 +4,9 @@ import random
 import sys
 import time
 
-from generator.gpt2.gpt2_generator import *
+import numpy as np
+
+from generator.remote import RemoteGenerator
 from story import grammars
 from story.story_manager import *
 from story.utils import *
@@ -157,7 +159,12 @@ def play_aidungeon_2():
     upload_story = True
 
     print("\nInitializing AI Dungeon! (This might take a few minutes)\n")
-    generator = GPT2Generator()
+    if "GENERATION_SERVER" in os.environ:
+        generator = RemoteGenerator(os.environ["GENERATION_SERVER"])
+    else:
+        from generator.gpt2.gpt2_generator import GPT2Generator
+
+        generator = GPT2Generator()
     story_manager = UnconstrainedStoryManager(generator)
     print("\n")
 
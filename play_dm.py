@@ -3,8 +3,8 @@ import os
 import sys
 import time
 
-from generator.gpt2.gpt2_generator import *
 from generator.human_dm import *
+from generator.remote import RemoteGenerator
 from play import *
 from story.story_manager import *
 from story.utils import *
@@ -17,13 +17,18 @@ class AIPlayer:
         self.generator = generator
 
     def get_action(self, prompt):
-        return self.generator.generate_raw(prompt)
+        return self.generator.generate_raw(prompt, {"temperature": 0.9})
 
 
 def play_dm():
 
     console_print("Initializing AI Dungeon DM Mode")
-    generator = GPT2Generator(temperature=0.9)
+    if "GENERATION_SERVER" in os.environ:
+        generator = RemoteGenerator(os.environ["GENERATION_SERVER"])
+    else:
+        from generator.gpt2.gpt2_generator import get_shared_generator
+
+        generator = get_shared_generator()
 
     story_manager = UnconstrainedStoryManager(HumanDM())
     context, prompt = select_game()
@@ -33,6 +33,19 @@ class Story:
         self.game_state = game_state
         self.memory = 20
 
+        # Most tokens of story to hand the generator, when it works in tokens.
+        # None means as many as the generator can take.
+        self.token_budget = None
+        # Token ids of each block of text, so nothing is tokenized twice
+        self.block_token_ids = {}
+        # First turn still in the generator's context, and how much of the
+        # budget is freed up when turns have to be dropped to make room
+        self.window_start = 0
+        self.evict_fraction = 0.25
+        # Whatever the generator keeps between turns to continue this story
+        # quickly, like the model's keys and values
+        self.generator_cache = {}
+
     def __del__(self):
         if self.upload_story:
             self.save_to_storage()
@@ -61,11 +74,60 @@ class Story:
         story_dict = json.loads(json_string)
         self.init_from_dict(story_dict)
 
-    def add_to_story(self, action, story_block):
+    def add_to_story(self, action, story_block, encode=None):
         self.actions.append(action)
         self.results.append(story_block)
+        if encode is not None:
+            self.block_tokens(action, encode)
+            self.block_tokens(story_block, encode)
+
+    def latest_result(self, encode=None, max_tokens=None):
+        """Build the text the generator continues the story from.
+
+        Without a tokenizer this keeps the last `memory` turns. With one, the
+        story start is always kept and is followed by a window of the most
+        recent turns that fits in max_tokens.
+        """
+        if encode is None or max_tokens is None:
+            return self.latest_memory_result()
+        return "".join(self.context_blocks(encode, max_tokens))
+
+    def latest_tokens(self, encode, max_tokens):
+        """Token ids of latest_result, joined from each block's own ids."""
+        tokens = []
+        for block in self.context_blocks(encode, max_tokens):
+            tokens.extend(self.block_tokens(block, encode))
+        return tokens
+
+    def context_blocks(self, encode, max_tokens):
+        # The window only moves once its turns stop fitting, and then drops
+        # enough of the oldest to free evict_fraction of the budget. Until
+        # it moves again every context starts with the same tokens, so the
+        # generator's cache covers all of it but the newest turn. The story
+        # start never moves, so it stays cached even when the window does.
+        budget = max_tokens - len(self.block_tokens(self.story_start, encode))
+        self.window_start = min(self.window_start, len(self.results))
+        cost = sum(
+            self.turn_tokens(i, encode)
+            for i in range(self.window_start, len(self.results))
+        )
+        if cost > budget:
+            target = budget * (1 - self.evict_fraction)
+            while self.window_start < len(self.results) and cost > target:
+                cost -= self.turn_tokens(self.window_start, encode)
+                self.window_start += 1
+
+        blocks = [self.story_start]
+        for i in range(self.window_start, len(self.results)):
+            blocks += [self.actions[i], self.results[i]]
+        return blocks
+
+    def turn_tokens(self, i, encode):
+        return len(self.block_tokens(self.actions[i], encode)) + len(
+            self.block_tokens(self.results[i], encode)
+        )
 
-    def latest_result(self):
+    def latest_memory_result(self):
 
         mem_ind = self.memory
         if len(self.results) < 2:
@@ -81,6 +143,14 @@ class Story:
 
         return latest_result
 
+    def block_tokens(self, text, encode):
+        # Blocks are tokenized on their own, so a context joined from them can
+        # differ slightly from tokenizing the whole text where BPE would have
+        # merged across a join
+        if text not in self.block_token_ids:
+            self.block_token_ids[text] = encode(text)
+        return self.block_token_ids[text]
+
     def __str__(self):
         story_list = [self.story_start]
         for i in range(len(self.results)):
@@ -165,11 +235,16 @@ class StoryManager:
     def __init__(self, generator):
         self.generator = generator
         self.story = None
+        # Options passed with every generate call, like sampling settings
+        self.options = None
 
     def start_new_story(
         self, story_prompt, context="", game_state=None, upload_story=False
     ):
-        block = self.generator.generate(context + story_prompt)
+        generator_cache = {}
+        block = self.generator.generate(
+            context + story_prompt, self.options, cache=generator_cache
+        )
         block = cut_trailing_sentence(block)
         self.story = Story(
             context + story_prompt + block,
@@ -177,8 +252,16 @@ class StoryManager:
             game_state=game_state,
             upload_story=upload_story,
         )
+        # The same dict, since the generator may be keeping count of it
+        self.story.generator_cache = generator_cache
         return str(self.story)
 
+    def close(self):
+        """Free the story's cache in the generator, once it won't be played."""
+        forget_cache = getattr(self.generator, "forget_cache", None)
+        if self.story is not None and forget_cache is not None:
+            forget_cache(self.story.generator_cache)
+
     def load_new_story(self, story_id, upload_story=False):
         file_name = "story" + story_id + ".json"
         cmd = "gsutil cp gs://aidungeonstories/" + file_name + " ."
@@ -205,19 +288,60 @@ class StoryManager:
     def json_story(self):
         return self.story.to_json()
 
-    def story_context(self):
-        return self.story.latest_result()
+    def context_budget(self):
+        """Most tokens of story the generator should be given, or None."""
+        budget = getattr(self.generator, "context_budget", None)
+        if budget is not None and self.story.token_budget is not None:
+            budget = min(budget, self.story.token_budget)
+        return budget
+
+    def story_context(self, action=""):
+        """The story so far, leaving room in the budget for action."""
+        budget = self.context_budget()
+        if budget is None:
+            return self.story.latest_result()
+        encode = self.generator.encode
+        return self.story.latest_result(
+            encode, budget - len(self.story.block_tokens(action, encode))
+        )
+
+    def story_context_tokens(self, action=""):
+        """Token ids of story_context, for generators that take tokens."""
+        encode = self.generator.encode
+        return self.story.latest_tokens(
+            encode, self.context_budget() - len(self.story.block_tokens(action, encode))
+        )
 
 
 class UnconstrainedStoryManager(StoryManager):
-    def act(self, action_choice):
-
-        result = self.generate_result(action_choice)
-        self.story.add_to_story(action_choice, result)
+    def act(self, action_choice, stream=None, cancelled=None):
+        """Continue the story from action_choice and add both to it.
+
+        If the threading.Event cancelled is set by the time the result is
+        ready, the action was given up on, and the story is left as it was.
+        """
+        result = self.generate_result(action_choice, stream)
+        if cancelled is not None and cancelled.is_set():
+            return result
+        self.story.add_to_story(
+            action_choice, result, getattr(self.generator, "encode", None)
+        )
         return result
 
-    def generate_result(self, action):
-        block = self.generator.generate(self.story_context() + action)
+    def generate_result(self, action, stream=None):
+        if hasattr(self.generator, "generate_tokens"):
+            tokens = self.story_context_tokens(action) + self.story.block_tokens(
+                action, self.generator.encode
+            )
+            return self.generator.generate_tokens(
+                tokens, self.options, cache=self.story.generator_cache, stream=stream
+            )
+        block = self.generator.generate(
+            self.story_context(action) + action,
+            self.options,
+            cache=self.story.generator_cache,
+            stream=stream,
+        )
         return block
 
 
@@ -0,0 +1,49 @@
+import numpy as np
+
+from generator.caches import CacheStore, cache_bytes
+
+
+def story_cache(tokens):
+    return {"tokens": list(range(tokens)), "presents": np.zeros(tokens, np.uint8)}
+
+
+def test_cache_bytes_counts_arrays():
+    assert cache_bytes(story_cache(10)) == 10
+    assert cache_bytes({}) == 0
+
+
+def test_least_recently_used_are_emptied_past_max_bytes():
+    store = CacheStore(max_bytes=25)
+    for key in "abc":
+        store.get(key).update(story_cache(10))
+    store.get("a")
+    store.trim()
+    # b went unused the longest, and without it the rest fit
+    assert store.dropped == 1
+    assert store.nbytes() == 20
+    assert store.get("b") == {}
+
+
+def test_the_cache_in_use_is_kept_even_if_too_big():
+    store = CacheStore(max_bytes=5)
+    store.get("a").update(story_cache(10))
+    store.trim()
+    assert store.dropped == 0 and store.nbytes() == 10
+
+
+def test_tracked_caches_are_emptied_where_their_story_holds_them():
+    store = CacheStore(max_bytes=15)
+    held = [story_cache(10), story_cache(10)]
+    for cache in held:
+        store.track(cache)
+    assert held[0] == {} and held[1]["tokens"]
+
+
+def test_forgotten_caches_are_emptied_and_let_go():
+    store = CacheStore(max_bytes=None)
+    cache = store.get("a")
+    cache.update(story_cache(10))
+    store.forget("a")
+    assert cache == {} and len(store) == 0
+    # Forgetting one that isn't kept does nothing
+    store.forget("b")
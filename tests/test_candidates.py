@@ -0,0 +1,78 @@
+import types
+
+import numpy as np
+import pytest
+
+from generator.gpt2 import generator_base
+from generator.gpt2.generator_base import GeneratorBase
+
+
+class Encoder:
+    """One token a character."""
+
+    decoder = {}
+
+    def encode(self, text):
+        return [ord(c) for c in text]
+
+    def decode(self, tokens):
+        return "".join(chr(t) for t in tokens)
+
+
+class ScriptedGenerator(GeneratorBase):
+    """Samples the given texts in order, a run at a time, instead of a model.
+
+    Each row's cache is marked with the text it got, to tell which candidate
+    was kept.
+    """
+
+    def __init__(self, runs, **kwargs):
+        super().__init__(censor=False, **kwargs)
+        self.runs = list(runs)
+        self.rows = []
+
+    def sample_batch(self, contexts, caches=None, streams=None, options=None):
+        texts = self.runs.pop(0)
+        self.rows.append(len(contexts))
+        for cache, text in zip(caches, texts):
+            if cache is not None:
+                cache["tokens"] = text
+                cache["presents"] = np.zeros(1)
+        return texts
+
+
+@pytest.fixture(autouse=True)
+def no_model_files(monkeypatch):
+    monkeypatch.setattr(generator_base.encoder, "get_encoder", lambda *args: Encoder())
+    monkeypatch.setattr(
+        GeneratorBase,
+        "load_hparams",
+        lambda self, path: types.SimpleNamespace(n_ctx=1024),
+    )
+
+
+def test_the_first_usable_candidate_is_kept():
+    generator = ScriptedGenerator([["", "It works.", "So does this."]], candidates=3)
+    cache = {}
+    assert generator.generate_tokens([1], cache=cache) == "It works"
+    assert cache["tokens"] == "It works."
+    assert generator.rows == [3]
+
+
+def test_a_prompt_with_no_usable_candidate_is_sampled_again():
+    runs = [["", "x", "Fine.", "Also fine."], ["No.", "Yes."]]
+    generator = ScriptedGenerator(runs, candidates=2)
+    assert generator.generate_tokens_batch([[1], [2]]) == ["No", "Fine"]
+    # Only the prompt that had nothing usable
+    assert generator.rows == [4, 2]
+
+
+def test_after_max_attempts_the_untrimmed_text_is_kept():
+    runs = [["", "x"], ["y", ""], ["a<b", "c"]]
+    generator = ScriptedGenerator(runs, candidates=2, max_attempts=3)
+    cache = {}
+    # Every result is cut to nothing, so the last run's first candidate is
+    # kept up to its stop string
+    assert generator.generate_tokens([1], cache=cache) == "a"
+    assert cache["tokens"] == "a<b"
+    assert generator.rows == [2, 2, 2]
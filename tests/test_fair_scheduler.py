@@ -0,0 +1,154 @@
+import threading
+import time
+
+import pytest
+
+from generator.fair_scheduler import FairScheduler, Withdrawn
+
+
+class FakeGenerator:
+    """Records the order requests run in, and how many run at once."""
+
+    generate_num = 10
+
+    def __init__(self):
+        self.ran = []
+        self.running = {}
+        self.most_running = {}
+        self.gate = threading.Event()
+        self.lock = threading.Lock()
+
+    def generate_tokens(self, context_tokens, options=None, cache=None, stream=None):
+        name = context_tokens
+        with self.lock:
+            self.ran.append(name)
+            game = name[0]
+            self.running[game] = self.running.get(game, 0) + 1
+            self.most_running[game] = max(
+                self.most_running.get(game, 0), self.running[game]
+            )
+        self.gate.wait()
+        with self.lock:
+            self.running[game] -= 1
+        return name
+
+
+def waiting(scheduler):
+    with scheduler._condition:
+        return sum(
+            len(requests)
+            for guild in scheduler._guilds.values()
+            for requests in guild.games.values()
+        )
+
+
+def wait_until(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def submit(scheduler, generator, guild, game, name):
+    """Send a request and return once it's running or waiting for a slot."""
+    before = waiting(scheduler), len(generator.ran)
+    thread = threading.Thread(
+        target=scheduler.game(guild, game).generate_tokens, args=(name,), daemon=True
+    )
+    thread.start()
+    wait_until(lambda: (waiting(scheduler), len(generator.ran)) != before)
+    return thread
+
+
+def run_in_order(scheduler, generator, requests):
+    """Queue requests behind one that holds the only slot, then let them all
+    run one at a time, and return the order they ran in."""
+    threads = [submit(scheduler, generator, "blocker", "blocker", "blocker")]
+    for guild, game, name in requests:
+        threads.append(submit(scheduler, generator, guild, game, name))
+    generator.gate.set()
+    for thread in threads:
+        thread.join(5)
+        assert not thread.is_alive()
+    return generator.ran[1:]
+
+
+def test_a_flooding_guild_does_not_starve_a_quiet_one():
+    generator = FakeGenerator()
+    scheduler = FairScheduler(generator, slots=1)
+    flood = [("flood", "f%d" % i, "f%d" % i) for i in range(6)]
+    order = run_in_order(scheduler, generator, flood + [("quiet", "q", "q")])
+    assert order.index("q") <= 1
+
+
+def test_games_in_a_guild_take_turns():
+    generator = FakeGenerator()
+    scheduler = FairScheduler(generator, slots=1, game_limit=3)
+    requests = [("guild", "a", "a%d" % i) for i in range(3)]
+    requests += [("guild", "b", "b%d" % i) for i in range(3)]
+    order = run_in_order(scheduler, generator, requests)
+    assert order == ["a0", "b0", "a1", "b1", "a2", "b2"]
+
+
+def test_games_can_have_any_key():
+    generator = FakeGenerator()
+    scheduler = FairScheduler(generator, slots=1)
+    requests = [("guild", 0, "a0"), ("guild", "", "b0"), ("guild", 0, "a1")]
+    assert run_in_order(scheduler, generator, requests) == ["a0", "b0", "a1"]
+
+
+def test_guilds_share_by_weight():
+    generator = FakeGenerator()
+    scheduler = FairScheduler(generator, slots=1, guild_weights={"big": 3})
+    requests = [("big", "b%d" % i, "b%d" % i) for i in range(9)]
+    requests += [("small", "s%d" % i, "s%d" % i) for i in range(3)]
+    order = run_in_order(scheduler, generator, requests)
+    first = order[:8]
+    assert sum(name.startswith("b") for name in first) == 6
+
+
+def test_a_game_only_runs_game_limit_requests_at_once():
+    generator = FakeGenerator()
+    scheduler = FairScheduler(generator, slots=4, game_limit=1)
+    threads = [submit(scheduler, generator, "guild", "a", "a%d" % i) for i in range(3)]
+    threads.append(submit(scheduler, generator, "guild", "b", "b0"))
+    # a0 and b0 run, while a1 and a2 wait for a0 though slots are free
+    assert sorted(generator.ran) == ["a0", "b0"]
+    assert waiting(scheduler) == 2
+    generator.gate.set()
+    for thread in threads:
+        thread.join()
+    assert generator.most_running == {"a": 1, "b": 1}
+
+
+def test_withdrawn_requests_never_run():
+    generator = FakeGenerator()
+    scheduler = FairScheduler(generator, slots=1)
+    blocker = submit(scheduler, generator, "guild", "blocker", "blocker")
+    errors = []
+
+    def withdrawn():
+        try:
+            scheduler.game("guild", "a").generate_tokens("a0")
+        except Withdrawn as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=withdrawn, daemon=True)
+    thread.start()
+    wait_until(lambda: waiting(scheduler) == 1)
+    quiet = submit(scheduler, generator, "guild", "b", "b0")
+    scheduler.game("guild", "a").withdraw()
+    thread.join(5)
+    assert errors and waiting(scheduler) == 1
+
+    generator.gate.set()
+    for thread in [blocker, quiet]:
+        thread.join(5)
+    assert generator.ran == ["blocker", "b0"]
+
+
+def test_weights_and_quantum_have_to_be_positive():
+    with pytest.raises(ValueError):
+        FairScheduler(FakeGenerator(), guild_weights={"guild": 0})
+    with pytest.raises(ValueError):
+        FairScheduler(FakeGenerator(), quantum=-1)
@@ -0,0 +1,161 @@
+import types
+
+import numpy as np
+import pytest
+
+from generator.gpt2.src import numpy_sample, numpy_speculative
+from generator.gpt2.src.numpy_model import Model, softmax
+
+HPARAMS = types.SimpleNamespace(n_vocab=8, n_ctx=32, n_embd=8, n_head=2, n_layer=2)
+
+
+def random_model(seed, scale=1.0):
+    """A tiny GPT-2 with random weights, sharp enough to have preferences."""
+    rng = np.random.RandomState(seed)
+    n_embd = HPARAMS.n_embd
+
+    def normal(*shape):
+        return (rng.standard_normal(shape) * scale).astype(np.float32)
+
+    weights = {
+        "model/wte": normal(HPARAMS.n_vocab, n_embd),
+        "model/wpe": normal(HPARAMS.n_ctx, n_embd),
+        "model/ln_f/g": np.ones(n_embd, np.float32),
+        "model/ln_f/b": np.zeros(n_embd, np.float32),
+    }
+    for layer in range(HPARAMS.n_layer):
+        prefix = "model/h%d/" % layer
+        for name, nx, nf in [
+            ("attn/c_attn", n_embd, 3 * n_embd),
+            ("attn/c_proj", n_embd, n_embd),
+            ("mlp/c_fc", n_embd, 4 * n_embd),
+            ("mlp/c_proj", 4 * n_embd, n_embd),
+        ]:
+            weights[prefix + name + "/w"] = normal(1, nx, nf) / np.sqrt(nx)
+            weights[prefix + name + "/b"] = np.zeros(nf, np.float32)
+        for name in ["ln_1", "ln_2"]:
+            weights[prefix + name + "/g"] = np.ones(n_embd, np.float32)
+            weights[prefix + name + "/b"] = np.zeros(n_embd, np.float32)
+    return Model(HPARAMS, weights)
+
+
+MODEL = random_model(0, scale=2.0)
+DRAFT = random_model(1, scale=2.0)
+PROMPT = [1, 2, 3, 4]
+
+
+def settings(rows, length):
+    return dict(
+        length=np.full([rows], length),
+        temperature=np.ones([rows], np.float32),
+        top_k=np.zeros([rows], np.int64),
+        top_p=np.ones([rows], np.float32),
+        penalty=np.ones([rows], np.float32),
+    )
+
+
+def sample(draft, rows, length, prompts=None, caches=None, lookahead=2, **kwargs):
+    prompts = prompts or [PROMPT] * rows
+    width = max(len(prompt) for prompt in prompts)
+    pads = np.array([width - len(prompt) for prompt in prompts])
+    context = np.array([[0] * pad + prompt for pad, prompt in zip(pads, prompts)])
+    arguments = dict(
+        model=MODEL,
+        context=context,
+        past=MODEL.past_buffer(rows, 0),
+        history=np.zeros([rows, 0], dtype=np.int64),
+        pads=pads,
+        **dict(settings(rows, length), **kwargs)
+    )
+    if draft is None:
+        return numpy_sample.sample_sequence(**arguments)
+    return numpy_speculative.sample_sequence(
+        draft=draft, lookahead=lookahead, caches=caches, **arguments
+    )
+
+
+def next_token_distribution(tokens):
+    past = MODEL.past_buffer(1, len(tokens))
+    logits = MODEL.forward(np.array([tokens]), past, 0, np.zeros([1], np.int64))
+    return softmax(logits[0].astype(np.float64))
+
+
+def total_variation(counts, expected):
+    return 0.5 * np.abs(counts / counts.sum() - expected).sum()
+
+
+def test_a_draft_that_is_the_model_is_always_kept():
+    _, _, _, drafted, kept = sample(MODEL, rows=3, length=6)
+    assert drafted > 0 and kept == drafted
+
+
+@pytest.mark.parametrize("lookahead", [1, 3])
+def test_samples_have_the_models_distribution(lookahead):
+    # The exact distribution of the first two sampled tokens
+    first = next_token_distribution(PROMPT)
+    second = sum(
+        first[token] * next_token_distribution(PROMPT + [token])
+        for token in range(HPARAMS.n_vocab)
+    )
+
+    np.random.seed(0)
+    rows = 3000
+    output, _, _, drafted, kept = sample(DRAFT, rows, length=2, lookahead=lookahead)
+    # The draft is a different model, so some of its tokens are replaced
+    assert 0 < kept < drafted
+    for position, expected in [(0, first), (1, second)]:
+        tokens = output[:, len(PROMPT) + position]
+        counts = np.bincount(tokens, minlength=HPARAMS.n_vocab)
+        assert total_variation(counts, expected) < 0.04
+
+    # As close as plain sampling gets
+    output, _, _ = sample(None, rows, length=2)
+    counts = np.bincount(output[:, len(PROMPT)], minlength=HPARAMS.n_vocab)
+    assert total_variation(counts, first) < 0.04
+
+
+def test_rows_that_stop_early_are_padded():
+    output, presents, lengths, _, _ = sample(DRAFT, 2, np.array([6, 2]))
+    assert lengths.tolist() == [6, 2]
+    assert output.shape[1] == len(PROMPT) + 6
+    # The short row isn't sampled past its own length
+    end = len(PROMPT) + 2
+    assert (output[1, end:] == 0).all()
+    assert (presents[1, :, :, :, end - 1 :] == 0).all()
+    assert (presents[1, :, :, :, : end - 1] != 0).any()
+
+
+def test_keys_and_values_match_a_plain_run():
+    np.random.seed(1)
+    output, presents, lengths, _, _ = sample(DRAFT, 1, 5)
+    tokens = output[0, : len(PROMPT) + lengths[0] - 1]
+    expected = MODEL.past_buffer(1, len(tokens))
+    MODEL.forward(np.array([tokens]), expected, 0, np.zeros([1], np.int64))
+    np.testing.assert_allclose(
+        presents[:, :, :, :, : len(tokens)], expected, rtol=1e-4, atol=1e-5
+    )
+
+
+def test_the_draft_continues_from_the_cache():
+    cache = {}
+    np.random.seed(2)
+    output, _, lengths, _, _ = sample(DRAFT, 1, 4, caches=[cache])
+    assert cache["draft_tokens"] == output[0, : len(cache["draft_tokens"])].tolist()
+    assert len(cache["draft_tokens"]) >= len(PROMPT)
+
+    runs = []
+    step = numpy_speculative.Row.step
+
+    def recorded_step(row, lookahead, budget):
+        runs.append(row.draft_run)
+        return step(row, lookahead, budget)
+
+    seen = len(cache["draft_tokens"])
+    story = output[0, : len(PROMPT) + lengths[0]].tolist() + [5]
+    numpy_speculative.Row.step = recorded_step
+    try:
+        sample(DRAFT, 1, 2, prompts=[story], caches=[cache])
+    finally:
+        numpy_speculative.Row.step = step
+    # The draft only runs over what it didn't see last time
+    assert runs[0] == seen
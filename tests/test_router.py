@@ -0,0 +1,132 @@
+import socket
+import types
+
+import pytest
+
+from generator import router
+from generator.remote import ServerUnreachable
+from generator.router import GenerationRouter, HashRing
+
+KEYS = range(5000)
+
+
+def placement(ring):
+    return {key: ring.node_for(key) for key in KEYS}
+
+
+def test_keys_are_spread_over_nodes():
+    before = placement(HashRing(["a", "b", "c"]))
+    for node in "abc":
+        share = sum(owner == node for owner in before.values()) / len(KEYS)
+        assert 0.2 < share < 0.45
+
+
+def test_adding_a_node_only_moves_keys_to_it():
+    ring = HashRing(["a", "b", "c"])
+    before = placement(ring)
+    ring.add("d")
+    after = placement(ring)
+    moved = [key for key in KEYS if before[key] != after[key]]
+    assert all(after[key] == "d" for key in moved)
+    assert 0.15 < len(moved) / len(KEYS) < 0.35
+
+
+def test_removing_a_node_only_moves_its_keys():
+    ring = HashRing(["a", "b", "c"])
+    before = placement(ring)
+    ring.remove("b")
+    after = placement(ring)
+    assert all(before[key] == "b" for key in KEYS if before[key] != after[key])
+    assert "b" not in after.values()
+
+
+def test_a_node_that_leaves_and_comes_back_gets_its_keys_back():
+    ring = HashRing(["a", "b", "c"])
+    before = placement(ring)
+    ring.remove("c")
+    ring.add("c")
+    assert placement(ring) == before
+
+
+def test_empty_ring():
+    with pytest.raises(LookupError):
+        HashRing().node_for("key")
+
+
+class FakeServer:
+    """Stands in for RemoteGenerator, with servers that are up or down."""
+
+    up = {}
+
+    def __init__(self, url, timeout=None):
+        self.url = url.rstrip("/")
+        if not self.up.get(self.url):
+            raise ConnectionRefusedError(self.url)
+        self.local = types.SimpleNamespace(censor=True)
+        self.served = 0
+
+    def generate_tokens(self, context_tokens, options=None, cache=None, stream=None):
+        if not self.up[self.url]:
+            raise ServerUnreachable(self.url)
+        self.served += 1
+        if self.up[self.url] == "slow":
+            raise socket.timeout("timed out")
+        return self.url
+
+
+@pytest.fixture
+def servers(monkeypatch):
+    monkeypatch.setattr(router, "RemoteGenerator", FakeServer)
+    monkeypatch.setattr(FakeServer, "up", {"http://a": True, "http://b": False})
+    return FakeServer.up
+
+
+def test_starts_with_a_server_down_and_takes_it_back(servers, monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(router.time, "monotonic", lambda: now[0])
+    r = GenerationRouter(["http://a", "http://b"], retry_delay=1, max_retry_delay=4)
+    assert sorted(r.nodes) == ["http://a"]
+    assert all(r.generate_tokens([1], key=key) == "http://a" for key in range(20))
+
+    servers["http://b"] = True
+    now[0] = 2.0
+    results = {r.generate_tokens([1], key=key) for key in range(20)}
+    assert results == {"http://a", "http://b"}
+    assert r.rejoined == 1 and not r.down
+
+
+def test_routes_around_a_server_that_goes_down(servers, monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(router.time, "monotonic", lambda: now[0])
+    servers["http://b"] = True
+    r = GenerationRouter(["http://a", "http://b"], retry_delay=1, max_retry_delay=4)
+    key = next(key for key in KEYS if r.ring.node_for(key) == "http://b")
+
+    servers["http://b"] = False
+    assert r.generate_tokens([1], key=key) == "http://a"
+    assert list(r.down) == ["http://b"]
+
+    # Checks that find it still down wait twice as long each time, up to 4 s
+    for now[0], delay in [(1.0, 2), (3.0, 4), (7.0, 4)]:
+        r.generate_tokens([1], key=key)
+        assert r.down["http://b"][1] == delay
+
+    servers["http://b"] = True
+    now[0] = 11.0
+    assert r.generate_tokens([1], key=key) == "http://b"
+
+
+def test_a_server_that_times_out_stays_on_the_ring(servers):
+    servers["http://b"] = True
+    r = GenerationRouter(["http://a", "http://b"])
+    key = next(key for key in KEYS if r.ring.node_for(key) == "http://b")
+
+    servers["http://b"] = "slow"
+    with pytest.raises(socket.timeout):
+        r.generate_tokens([1], key=key)
+    # It may have started generating, so the request isn't sent again
+    assert r.nodes["http://b"].served == 1 and r.nodes["http://a"].served == 0
+    assert not r.down and r.removed == 0
+
+    servers["http://b"] = True
+    assert r.generate_tokens([1], key=key) == "http://b"
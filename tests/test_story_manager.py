@@ -0,0 +1,104 @@
+from story.story_manager import Story, UnconstrainedStoryManager
+
+
+def encode(text):
+    """One token a word."""
+    return text.split()
+
+
+def story(turns):
+    """A story whose start is 2 tokens and whose turns are 5 each."""
+    s = Story("once upon")
+    for i in range(turns):
+        s.add_to_story("act%d" % i, "result %d of turn" % i, encode)
+    return s
+
+
+def test_the_window_stays_put_while_it_fits():
+    s = story(2)
+    assert s.context_blocks(encode, 12) == [
+        "once upon",
+        "act0",
+        "result 0 of turn",
+        "act1",
+        "result 1 of turn",
+    ]
+    assert s.window_start == 0
+
+
+def test_the_window_frees_evict_fraction_once_it_overflows():
+    s = story(3)
+    blocks = s.context_blocks(encode, 12)
+    # 15 tokens of turns don't fit in 10, and dropping one turn would leave
+    # 10, more than the 7.5 that frees a quarter of the budget
+    assert s.window_start == 2
+    assert blocks == ["once upon", "act2", "result 2 of turn"]
+
+
+def test_the_window_only_moves_when_full_again():
+    s = story(3)
+    s.context_blocks(encode, 12)
+    s.add_to_story("act3", "result 3 of turn", encode)
+    # Every context since the last move starts with the same tokens
+    assert s.context_blocks(encode, 12)[:3] == ["once upon", "act2", "result 2 of turn"]
+    assert s.window_start == 2
+    s.add_to_story("act4", "result 4 of turn", encode)
+    s.context_blocks(encode, 12)
+    assert s.window_start == 4
+
+
+def test_the_story_start_is_always_kept():
+    s = story(5)
+    for budget in [3, 7, 12, 100]:
+        assert s.context_blocks(encode, budget)[0] == "once upon"
+    # Even when there's no room for any turn
+    assert s.context_blocks(encode, 3) == ["once upon"]
+
+
+def test_latest_tokens_are_the_blocks_tokens():
+    s = story(3)
+    blocks = s.context_blocks(encode, 12)
+    assert s.latest_tokens(encode, 12) == [
+        token for block in blocks for token in encode(block)
+    ]
+    assert s.latest_result(encode, 12) == "".join(blocks)
+
+
+class Generator:
+    """Counts words as tokens and can take context_budget of them."""
+
+    def __init__(self, context_budget=None):
+        if context_budget is not None:
+            self.context_budget = context_budget
+
+    def encode(self, text):
+        return encode(text)
+
+
+def manager(generator, token_budget=None):
+    m = UnconstrainedStoryManager(generator)
+    m.story = story(3)
+    m.story.token_budget = token_budget
+    return m
+
+
+def test_the_budget_is_the_smaller_of_the_generators_and_the_storys():
+    assert manager(Generator(20)).context_budget() == 20
+    assert manager(Generator(20), token_budget=12).context_budget() == 12
+    assert manager(Generator(12), token_budget=20).context_budget() == 12
+
+
+def test_the_context_leaves_room_for_the_action():
+    m = manager(Generator(14))
+    action = "two words"
+    tokens = m.story_context_tokens(action)
+    assert len(tokens) + len(encode(action)) <= 14
+    # Only room for the latest turn next to the action
+    assert tokens == encode("once upon act2 result 2 of turn")
+    assert m.story_context(action) == "once uponact2result 2 of turn"
+
+
+def test_without_a_budget_the_last_turns_are_kept():
+    m = manager(Generator())
+    assert m.context_budget() is None
+    assert m.story_context() == m.story.latest_memory_result()